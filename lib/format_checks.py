@@ -3,10 +3,17 @@
 import sys
 import os
 import re
+import time
 import subprocess
 import itertools
 import tempfile
 import difflib
+import marshal
+import hashlib
+import fcntl
+
+import git_objects
+from nanny_metrics import metrics
 
 
 ZEROS = '0' * 40
@@ -36,6 +43,67 @@ def get_git_version():
 
 GIT_VERSION = get_git_version()
 GIT_CHECK_ATTR_CACHED = GIT_VERSION >= [1, 7, 8]
+GIT_CHECK_ATTR_Z_OUTPUT = GIT_VERSION >= [1, 8, 5]
+GIT_GLOB_PATHSPEC = GIT_VERSION >= [1, 8, 3]
+
+
+_git_config = None
+
+
+def read_git_config():
+    """Return the git configuration as a map {name : [value, ...]}.
+
+    Names are lower-cased (except for subsection names, which git
+    treats case-sensitively).  The configuration is read only once per
+    process."""
+
+    global _git_config
+
+    if _git_config is None:
+        cmd = ['git', 'config', '-z', '--list']
+        p = subprocess.Popen(
+            cmd,
+            stdout=subprocess.PIPE, stderr=subprocess.PIPE,
+            )
+        (out, err) = p.communicate()
+        retcode = p.wait()
+        if retcode or err:
+            sys.exit('Command failed: %s' % (' '.join(cmd),))
+
+        _git_config = {}
+        for entry in out.split('\0'):
+            if not entry:
+                continue
+            (name, value) = (entry.split('\n', 1) + [None])[:2]
+            _git_config.setdefault(name, []).append(value)
+
+    return _git_config
+
+
+def get_config(name, default=None):
+    """Return the last value of git configuration setting name."""
+
+    values = read_git_config().get(name)
+    if not values:
+        return default
+    return values[-1]
+
+
+def get_config_all(name):
+    """Return a list of all values of git configuration setting name."""
+
+    return list(read_git_config().get(name, []))
+
+
+def get_config_bool(name, default=False):
+    values = read_git_config().get(name)
+    if not values:
+        return default
+    value = values[-1]
+    if value is None:
+        # A setting with no '=' at all means "true":
+        return True
+    return value.lower() not in ['false', 'no', 'off', '0', '']
 
 
 # The string that is used as a marker for "don't check me in!".  This
@@ -45,17 +113,165 @@ def get_git_version():
 
 
 class Reporter(object):
-    def warning(self, msg):
-        sys.stderr.write(msg + '\n')
+    """Collect warnings and write them to stderr in bulk.
+
+    Warnings are buffered and written out whenever flush_size of them
+    have accumulated, or when flush() or close() is called.  Duplicate
+    messages are output only once.  At most max_per_category messages
+    are output per category (categories are descriptions like 'files
+    with trailing whitespace') and at most max_total altogether;
+    close() summarizes how many were suppressed.  If report_file is
+    set, close() writes all of the messages to that file."""
+
+    flush_size = 100
+
+    def __init__(self, max_per_category=None, max_total=None, report_file=None):
+        self.max_per_category = max_per_category
+        self.max_total = max_total
+        self.report_file = report_file
+        self.recorded = None
+        self.silent = False
+        self.buffer = []
+        self._reset()
+
+    def _reset(self):
+        self.seen = set()
+        self.all_messages = []
+        self.category_counts = {}
+        self.total = 0
+        self.suppressed = []
+        self.suppressed_counts = {}
+
+    def warning(self, msg, category=None):
+        if self.recorded is not None:
+            self.recorded.append((msg, category))
+            if self.silent:
+                return
+
+        if msg in self.seen:
+            return
+        self.seen.add(msg)
+        if self.report_file is not None:
+            self.all_messages.append(msg)
+
+        count = self.category_counts.get(category, 0)
+        if (
+                (self.max_per_category is not None and count >= self.max_per_category)
+                or (self.max_total is not None and self.total >= self.max_total)
+                ):
+            if category not in self.suppressed_counts:
+                self.suppressed.append(category)
+                self.suppressed_counts[category] = 0
+            self.suppressed_counts[category] += 1
+            return
+
+        self.category_counts[category] = count + 1
+        self.total += 1
+        self.buffer.append(msg + '\n')
+        if len(self.buffer) >= self.flush_size:
+            self.flush()
+
+    def flush(self):
+        """Write any buffered messages to stderr."""
+
+        if self.buffer:
+            sys.stderr.write(''.join(self.buffer))
+            self.buffer = []
+
+    def close(self):
+        """Output everything that is pending and start afresh.
+
+        Flush the buffer, summarize the suppressed messages, and write
+        the report file (if configured)."""
+
+        for category in self.suppressed:
+            self.buffer.append('... and %s more %s\n' % (
+                format(self.suppressed_counts[category], ','),
+                category or 'warnings',
+                ))
+
+        if self.report_file is not None and self.all_messages:
+            write_file_atomically(
+                self.report_file, ''.join(msg + '\n' for msg in self.all_messages),
+                )
+            if self.suppressed:
+                self.buffer.append(
+                    '(The full list of problems was written to %s.)\n' % (self.report_file,)
+                    )
+
+        self.flush()
+        self._reset()
+
+    def start_recording(self, silent=False):
+        """Start remembering the messages that are output.
+
+        If silent is True, remember them without outputting them."""
+
+        self.recorded = []
+        self.silent = silent
+
+    def stop_recording(self):
+        """Stop remembering messages.
+
+        Return a list of (msg, category) for the warnings issued since
+        start_recording()."""
+
+        (messages, self.recorded) = (self.recorded, None)
+        self.silent = False
+        return messages
 
 
 reporter = Reporter()
 
 
+# The counters that describe the outcome of checks rather than the work
+# done for them.  The caches of check results record them along with
+# the warnings, so that a cached result is counted like a fresh one:
+OUTCOME_COUNTERS = ('check_failures',)
+
+
+def _run_recorded(check, args, silent=False):
+    """Return (ok, messages, increments) for check(*args).
+
+    messages are the warnings and increments the changes to the
+    OUTCOME_COUNTERS that the check caused, in the form expected by
+    _replay_recorded().  If silent is True, the warnings are not
+    output."""
+
+    reporter.start_recording(silent=silent)
+    metrics.start_recording(OUTCOME_COUNTERS)
+    try:
+        ok = bool(check(*args))
+    finally:
+        increments = metrics.stop_recording()
+        messages = reporter.stop_recording()
+    return (ok, messages, increments)
+
+
+def _replay_recorded(messages, increments):
+    """Repeat the warnings and counter increments recorded by _run_recorded()."""
+
+    for (msg, category) in messages:
+        reporter.warning(msg, category)
+    metrics.replay(increments)
+
+
 class MissingContentsException(Exception):
     pass
 
 
+class DeadlineExceeded(Exception):
+    """Raised by FileCheckAdapter when a commit's deadline has passed."""
+
+    pass
+
+
+class ConfigError(Exception):
+    """Raised when a git configuration setting used by a check is invalid."""
+
+    pass
+
+
 def read_updates(f):
     """Iterate over (oldrev, newrev, refname) for updates read from f.
 
@@ -94,20 +310,55 @@ def get_new_commits(updates):
         cmd, stdout=subprocess.PIPE,
         )
 
-    new_commits = {}
-    for line in p.stdout:
-        words = line.strip().split()
-        new_commits[words[0]] = (set(words[1:]), set())
+    new_commits = parse_commit_graph(p.stdout)
 
     retcode = p.wait()
     if retcode:
         sys.exit('Error running command: %s' % (' '.join(cmd),))
 
+    return new_commits
+
+
+def get_commit_graph(sha1s):
+    """Return the graph of the commits sha1s in the form returned by get_new_commits().
+
+    Unlike get_new_commits(), this works regardless of whether the
+    commits are already reachable from references (e.g., when
+    replaying a push that was recorded earlier)."""
+
+    if not sha1s:
+        # "git log" would fall back to HEAD:
+        return {}
+
+    cmd = ['git', 'log', '--no-walk', '--format=%H %P', '--stdin']
+    p = subprocess.Popen(
+        cmd, stdin=subprocess.PIPE, stdout=subprocess.PIPE,
+        )
+    (out, err) = p.communicate(''.join(['%s\n' % (sha1,) for sha1 in sha1s]))
+    retcode = p.wait()
+    if retcode:
+        sys.exit('Error running command: %s' % (' '.join(cmd),))
+
+    return parse_commit_graph(out.splitlines())
+
+
+def parse_commit_graph(lines):
+    """Parse lines of the form 'SHA1 PARENT...' into a commit graph.
+
+    Return a map {sha1 : (set(parents), set(children))} like that
+    returned by get_new_commits().  Parents that are not themselves
+    among the listed commits are omitted."""
+
+    commits = {}
+    for line in lines:
+        words = line.strip().split()
+        commits[words[0]] = (set(words[1:]), set())
+
     # Tell the parents about their children:
-    for (sha1, (parents, children)) in new_commits.iteritems():
+    for (sha1, (parents, children)) in commits.iteritems():
         for parent in list(parents):
             try:
-                (grandparents, siblings) = new_commits[parent]
+                (grandparents, siblings) = commits[parent]
             except KeyError:
                 # The parent must have been an old commit; we're not
                 # interested in it:
@@ -115,7 +366,7 @@ def get_new_commits(updates):
             else:
                 siblings.add(sha1)
 
-    return new_commits
+    return commits
 
 
 def topo_sort_commits(commits):
@@ -183,15 +434,19 @@ def __init__(self, line):
 
 class GitCommitMetadata(object):
     def __init__(self, sha1):
-        cmd = ['git', 'cat-file', 'commit', sha1]
-        p = subprocess.Popen(
-            cmd,
-            stdout=subprocess.PIPE, stderr=subprocess.PIPE,
+        out = read_object(
+            git_objects.ObjectDatabase.read_typed, sha1, git_objects.OBJ_COMMIT,
             )
-        (out, err) = p.communicate()
-        retcode = p.wait()
-        if retcode or err:
-            sys.exit('Command failed: %s' % (' '.join(cmd),))
+        if out is None:
+            cmd = ['git', 'cat-file', 'commit', sha1]
+            p = subprocess.Popen(
+                cmd,
+                stdout=subprocess.PIPE, stderr=subprocess.PIPE,
+                )
+            (out, err) = p.communicate()
+            retcode = p.wait()
+            if retcode or err:
+                sys.exit('Command failed: %s' % (' '.join(cmd),))
 
         # The log message follows the first blank line:
         log_message_index = out.index('\n\n') + 2
@@ -216,6 +471,10 @@ def __init__(self, sha1):
 
 
 class Commit(object):
+    # An object that is called instead of a FileCheck to possibly
+    # reuse earlier results (see StatCache), or None:
+    file_check_cache = None
+
     def get_metadata(self):
         """Return a GitCommitMetadata object for this commit.
 
@@ -233,14 +492,18 @@ def get_logmsg(self):
 
         return self.get_metadata().logmsg
 
-    def iter_changes(self, attr_names):
+    def iter_changes(self, attr_names, pathspec_attr_names=None, pickaxe=None):
         """Iterate over the FileChanges in this Commit.
 
         Iterate over a FileChange object for each file that was
         changed in this commit, relative to its first parent.
         Contents are the new file contents, as a string, or None if
         the file was deleted.  attr_names is an iterable over the
-        names of attributes that should be checked."""
+        names of attributes that should be checked.  If
+        pathspec_attr_names is set, then changes to files for which
+        none of those attributes are set may be omitted.  If pickaxe
+        is set, then changes whose diffs don't add or remove a line
+        containing that string may be omitted."""
 
         raise NotImplementedError()
 
@@ -272,16 +535,21 @@ def __init__(self, filename, mode, sha1, attributes=None):
     @property
     def contents(self):
         if self._contents is None:
-            cmd = ['git', 'cat-file', 'blob', self.sha1]
-            p = subprocess.Popen(
-                cmd,
-                stdout=subprocess.PIPE, stderr=subprocess.PIPE,
+            out = read_object(
+                git_objects.ObjectDatabase.read_typed, self.sha1, git_objects.OBJ_BLOB,
                 )
-            (out, err) = p.communicate()
-            retcode = p.wait()
-            if retcode or err:
-                raise MissingContentsException('Command failed: %s' % (' '.join(cmd),))
+            if out is None:
+                cmd = ['git', 'cat-file', 'blob', self.sha1]
+                p = subprocess.Popen(
+                    cmd,
+                    stdout=subprocess.PIPE, stderr=subprocess.PIPE,
+                    )
+                (out, err) = p.communicate()
+                retcode = p.wait()
+                if retcode or err:
+                    raise MissingContentsException('Command failed: %s' % (' '.join(cmd),))
             self._contents = out
+            metrics.incr('bytes_read', len(out))
 
         return self._contents
 
@@ -298,6 +566,7 @@ def __init__(self, commit, filename, mode, attributes=None):
     def contents(self):
         if self._contents is None:
             self._contents = self.commit.read_contents(self.filename)
+            metrics.incr('bytes_read', len(self._contents))
         return self._contents
 
 
@@ -344,18 +613,414 @@ def new_lines(self):
         return self._new_lines
 
 
+def read_cache_file(filename, default):
+    """Read a value that was stored by write_cache_file().
+
+    If the file doesn't exist or cannot be read, return default."""
+
+    try:
+        f = open(filename, 'rb')
+    except IOError:
+        return default
+    try:
+        try:
+            return marshal.load(f)
+        except (EOFError, ValueError, TypeError):
+            return default
+    finally:
+        f.close()
+
+
+def write_file_atomically(filename, contents, mode=None):
+    """Write contents to filename such that readers never see a partial file.
+
+    If mode is set, give the file those permissions (otherwise it is
+    only accessible by its owner)."""
+
+    dirname = os.path.dirname(os.path.abspath(filename))
+    if not os.path.isdir(dirname):
+        os.makedirs(dirname)
+    (fd, tmpname) = tempfile.mkstemp(dir=dirname, prefix='.tmp-')
+    try:
+        f = os.fdopen(fd, 'wb')
+        f.write(contents)
+        f.close()
+        if mode is not None:
+            os.chmod(tmpname, mode)
+        os.rename(tmpname, filename)
+    except:
+        os.remove(tmpname)
+        raise
+
+
+def write_cache_file(filename, value):
+    """Store value (which must be marshalable) to filename."""
+
+    write_file_atomically(filename, marshal.dumps(value))
+
+
+def _run_git_dir_command(arg):
+    cmd = ['git', 'rev-parse', arg]
+    p = subprocess.Popen(
+        cmd,
+        stdout=subprocess.PIPE, stderr=subprocess.PIPE,
+        )
+    (out, err) = p.communicate()
+    retcode = p.wait()
+    if retcode or err:
+        sys.exit('Command failed: %s' % (' '.join(cmd),))
+    return os.path.abspath(out.rstrip('\n'))
+
+
+_git_dirs = {}
+
+
+def get_git_dir():
+    """Return the absolute path of $GIT_DIR."""
+
+    if 'git-dir' not in _git_dirs:
+        _git_dirs['git-dir'] = _run_git_dir_command('--git-dir')
+    return _git_dirs['git-dir']
+
+
+def get_nanny_dir():
+    """Return the directory in which git-nanny stores its caches."""
+
+    return os.path.join(get_git_dir(), 'nanny')
+
+
+def get_git_common_dir():
+    """Return the absolute path of the directory shared by all worktrees."""
+
+    if 'common-dir' not in _git_dirs:
+        if GIT_VERSION >= [2, 5]:
+            _git_dirs['common-dir'] = _run_git_dir_command('--git-common-dir')
+        else:
+            _git_dirs['common-dir'] = get_git_dir()
+    return _git_dirs['common-dir']
+
+
+_object_database = None
+
+
+def get_object_database():
+    """Return the git_objects.ObjectDatabase for the repository, or None.
+
+    Objects are only read in-process if nanny.objectReader is set to
+    "python" (the default is "cat-file")."""
+
+    global _object_database
+
+    if _object_database is None:
+        _object_database = False
+        if (
+                get_config('nanny.objectreader', 'cat-file') == 'python'
+                and get_config('extensions.objectformat', 'sha1') == 'sha1'
+                ):
+            try:
+                _object_database = git_objects.ObjectDatabase(get_git_common_dir())
+            except git_objects.ObjectReadError:
+                pass
+
+    return _object_database or None
+
+
+def read_object(read, *args):
+    """Read an object in-process by calling read(db, *args).
+
+    read is one of the reading methods of git_objects.ObjectDatabase
+    (e.g., ObjectDatabase.read_path).  Return None if in-process
+    reading is disabled or the object cannot be read that way, in
+    which case the caller should fall back to "git cat-file"."""
+
+    db = get_object_database()
+    if db is None:
+        return None
+
+    try:
+        data = read(db, *args)
+    except git_objects.READ_ERRORS:
+        metrics.incr('object_reads', labels=(('reader', 'fallback'),))
+        return None
+    else:
+        metrics.incr('object_reads', labels=(('reader', 'python'),))
+        return data
+
+
+# Attribute macros that git defines intrinsically:
+BUILTIN_ATTRIBUTE_MACROS = {
+    'binary' : ['-diff', '-merge', '-text'],
+    }
+
+
+def parse_gitattributes(contents):
+    """Parse the contents of a gitattributes file.
+
+    Return (macros, rules), where macros is a map {name : [state,
+    ...]} for the "[attr]" macro definitions in the file and rules is
+    a list of (pattern, [state, ...]) for the other lines.  Each state
+    is an attribute as written in the file (e.g., 'text', '-text',
+    '!text', or 'eol=lf')."""
+
+    macros = {}
+    rules = []
+    for line in contents.splitlines():
+        words = line.split()
+        if not words or words[0].startswith('#'):
+            continue
+        if words[0].startswith('[attr]'):
+            macros[words[0][len('[attr]'):]] = words[1:]
+        else:
+            rules.append((words[0], words[1:]))
+
+    return (macros, rules)
+
+
+def _state_sets_attribute(state, attr_names, macros, expanding=()):
+    """Return True iff state might set (or give a value to) one of attr_names.
+
+    state is an attribute state as returned by parse_gitattributes().
+    Macros are expanded recursively."""
+
+    if state.startswith('-') or state.startswith('!'):
+        # Unsetting or unspecifying an attribute never makes a check
+        # applicable:
+        return False
+
+    name = state.split('=', 1)[0]
+    if name in attr_names:
+        return True
+
+    if name in macros and name not in expanding and '=' not in state:
+        return any(
+            _state_sets_attribute(s, attr_names, macros, expanding + (name,))
+            for s in macros[name]
+            )
+
+    return False
+
+
+def _ere_escape(s):
+    """Escape s for use as a literal in a POSIX extended regular expression."""
+
+    return re.sub(r'([\\.\[\]()*+?{}|^$])', r'\\\1', s)
+
+
+def _pattern_to_pathspec(directory, pattern):
+    """Convert a gitattributes pattern into an equivalent pathspec.
+
+    directory is the path of the directory containing the
+    gitattributes file, relative to the top of the working tree ('' or
+    ending with '/').  Return a pathspec that matches at least the
+    files that pattern matches, the empty string if pattern cannot
+    match any file, or None if the pattern cannot be converted."""
+
+    if pattern.startswith('"'):
+        # Quoted patterns are not worth the trouble:
+        return None
+    elif pattern.startswith('!') or pattern.endswith('/'):
+        # Negative patterns are ignored by git, and patterns with a
+        # trailing slash only match directories:
+        return ''
+
+    if '/' in pattern:
+        # The pattern is anchored to directory:
+        if pattern.startswith('/'):
+            pattern = pattern[1:]
+        path = directory + pattern
+    else:
+        # The pattern matches the basename at any depth below
+        # directory:
+        path = directory + '**/' + pattern
+
+    if get_config_bool('core.ignorecase'):
+        return ':(top,glob,icase)' + path
+    else:
+        return ':(top,glob)' + path
+
+
+_gitattributes_cache = {}
+_attribute_pathspec_cache = {}
+
+
+def get_attribute_pathspec(sources, attr_names):
+    """Derive a pathspec for the files that can have one of attr_names set.
+
+    sources is a list of (directory, key, contents) for the
+    gitattributes files that apply, where directory is as for _pattern_to_pathspec() and key is a
+    tuple identifying the contents of the file (e.g., ('blob', sha1)).
+    contents is a callable that returns the contents of the file.
+
+    Return a list of pathspecs that match at least the files for which
+    one of attr_names might be set, or None if no such pathspec can be
+    derived.  The result is memoized on the keys of sources, so any
+    change to any of the files leads to the pathspec being derived
+    anew."""
+
+    attr_names = frozenset(attr_names)
+    cache_key = (attr_names, tuple((directory, key) for (directory, key, contents) in sources))
+    try:
+        pathspec = _attribute_pathspec_cache[cache_key]
+    except KeyError:
+        metrics.incr('cache_misses', labels=(('cache', 'attribute-pathspec'),))
+    else:
+        metrics.incr('cache_hits', labels=(('cache', 'attribute-pathspec'),))
+        return pathspec
+
+    parsed = []
+    for (directory, key, contents) in sources:
+        try:
+            parsed.append((directory, _gitattributes_cache[key]))
+        except KeyError:
+            _gitattributes_cache[key] = parse_gitattributes(contents())
+            parsed.append((directory, _gitattributes_cache[key]))
+
+    # git uses the definition of each macro from the file with the
+    # highest precedence ($GIT_DIR/info/attributes, then the top-level
+    # .gitattributes, ...), which is not the order of sources.  The
+    # pathspec only has to cover the files that might have the
+    # attributes, so use the union of all definitions of each macro:
+    macros = {}
+    for (name, states) in BUILTIN_ATTRIBUTE_MACROS.iteritems():
+        macros[name] = list(states)
+    for (directory, (file_macros, rules)) in parsed:
+        for (name, states) in file_macros.iteritems():
+            macros.setdefault(name, []).extend(states)
+
+    pathspec = []
+    for (directory, (file_macros, rules)) in parsed:
+        for (pattern, states) in rules:
+            if any(_state_sets_attribute(state, attr_names, macros) for state in states):
+                path = _pattern_to_pathspec(directory, pattern)
+                if path is None:
+                    pathspec = None
+                    break
+                elif path and path not in pathspec:
+                    pathspec.append(path)
+        if pathspec is None:
+            break
+
+    _attribute_pathspec_cache[cache_key] = pathspec
+    return pathspec
+
+
+def _read_file_if_exists(filename):
+    try:
+        f = open(filename, 'rb')
+    except IOError:
+        return None
+    contents = f.read()
+    f.close()
+    return contents
+
+
+_system_attributes_filename = []
+
+
+def get_system_attributes_filename():
+    """Return the name of the system-wide gitattributes file that git reads.
+
+    Return '' if git doesn't read such a file (because
+    GIT_ATTR_NOSYSTEM is set), or None if its name cannot be
+    determined."""
+
+    if os.environ.get('GIT_ATTR_NOSYSTEM', '').lower() in ['1', 'true', 'yes', 'on']:
+        return ''
+
+    if not _system_attributes_filename:
+        filename = None
+        if GIT_VERSION >= [2, 42]:
+            p = subprocess.Popen(
+                ['git', 'var', 'GIT_ATTR_SYSTEM'],
+                stdout=subprocess.PIPE, stderr=subprocess.PIPE,
+                )
+            (out, err) = p.communicate()
+            if not p.wait():
+                filename = out.strip()
+        else:
+            # Derive the name the way git's Makefile does: the file is
+            # $(sysconfdir)/gitattributes, where sysconfdir is /etc if
+            # prefix is /usr and $(prefix)/etc otherwise.
+            p = subprocess.Popen(
+                ['git', '--exec-path'],
+                stdout=subprocess.PIPE, stderr=subprocess.PIPE,
+                )
+            (out, err) = p.communicate()
+            exec_path = out.strip().rstrip('/')
+            if not p.wait():
+                for suffix in ['/libexec/git-core', '/lib/git-core']:
+                    if exec_path.endswith(suffix):
+                        prefix = exec_path[:-len(suffix)]
+                        if prefix == '/usr':
+                            filename = '/etc/gitattributes'
+                        else:
+                            filename = prefix + '/etc/gitattributes'
+                        break
+        _system_attributes_filename.append(filename)
+
+    return _system_attributes_filename[0]
+
+
+def get_global_attribute_sources():
+    """Return the sources for the gitattributes files outside of the tree.
+
+    Return a list of (directory, key, contents) as expected by
+    get_attribute_pathspec(), for the system-wide, user-global, and
+    $GIT_DIR/info/attributes files, in order of increasing
+    precedence.  (If the name of the system-wide file cannot be
+    determined, it is omitted; see get_system_attributes_filename().)"""
+
+    filenames = []
+    system_filename = get_system_attributes_filename()
+    if system_filename:
+        filenames.append(system_filename)
+    global_filename = get_config('core.attributesfile')
+    if global_filename is None:
+        global_filename = os.path.join(
+            os.environ.get('XDG_CONFIG_HOME') or os.path.expanduser('~/.config'),
+            'git', 'attributes',
+            )
+    filenames.append(os.path.expanduser(global_filename))
+    filenames.append(os.path.join(get_git_common_dir(), 'info', 'attributes'))
+
+    sources = []
+    for filename in filenames:
+        contents = _read_file_if_exists(filename)
+        if contents is not None:
+            sources.append(('', ('file', contents), lambda contents=contents: contents))
+    return sources
+
+
 class AbstractGitCommit(Commit):
     # The empty tree object seems to be understood intrinsically even
     # when it is not present in the repository:
     EMPTY_TREE_SHA1 = '4b825dc642cb6eb9a060e54bf8d69288fbee4904'
 
-    def __init__(self, filenames=None):
+    def __init__(self, filenames=None, limit=None):
         """Create an object representing a git commit.
 
         If filenames is set, then the commit is made to look like a
-        list of adds of exactly those files."""
+        list of adds of exactly those files.  Otherwise, if limit is
+        set, then only changes to the listed paths are considered."""
 
         self.filenames = filenames
+        self.limit = limit
+        self._attribute_sources = None
+        self._attribute_state = None
+        # The raw output of the diff command, memoized by (pathspec,
+        # pickaxe):
+        self._diffs = {}
+        # {filename : (set of attribute names looked up, {attribute : value})}:
+        self._attributes = {}
+        # The names of attributes to look up along with any others
+        # (e.g., those that checks to be run later will need), so
+        # that they can share a single lookup:
+        self.prefetch_attr_names = []
+        # The names of the files that failed a FileCheck:
+        self.failed_filenames = set()
+        # If set, the time.time() after which FileCheckAdapter gives
+        # up by raising DeadlineExceeded:
+        self.deadline = None
 
     def _get_base(self, committish):
         """Find a SHA1 that can be used as a tree for committish.
@@ -388,15 +1053,40 @@ def read_contents(self, filename):
 
         raise NotImplementedError()
 
-    def _get_diff_command(self):
-        """Return the command to read the diff."""
+    def _get_diff_command(self, pathspec=None, options=[]):
+        """Return the command to read the diff.
+
+        If pathspec is set, limit the diff to paths matching it.
+        options are additional options for the diff command."""
 
         raise NotImplementedError()
 
-    def _iter_changes_simple(self):
-        cmd = self._get_diff_command()
+    def get_tree(self):
+        """Return the SHA1 of the tree holding the contents of this commit.
+
+        Return None if there is no such tree."""
+
+        return None
+
+    def get_dirty_paths(self):
+        """Return the paths whose contents might differ from those in get_tree()."""
+
+        return []
+
+    def _get_paths(self, pathspec):
+        """Return the paths to append to the diff command."""
+
+        return self.filenames or self.limit or pathspec or []
+
+    def _list_gitattributes_files(self, env=None):
+        """Return [(filename, mode, sha1)] for the .gitattributes files in the index."""
+
+        cmd = [
+            'git', 'ls-files', '--stage', '--full-name', '-z',
+            '--', ':(top,glob)**/.gitattributes',
+            ]
         p = subprocess.Popen(
-            cmd,
+            cmd, env=env,
             stdout=subprocess.PIPE, stderr=subprocess.PIPE,
             )
         (out, err) = p.communicate()
@@ -404,11 +1094,104 @@ def _iter_changes_simple(self):
         if retcode or err:
             sys.exit('Command failed: %s' % (' '.join(cmd),))
 
-        words = out.split('\0')
-        del out
-        words.pop()
+        files = []
+        for entry in out.split('\0'):
+            if not entry:
+                continue
+            (info, filename) = entry.split('\t', 1)
+            (mode, sha1, stage) = info.split(' ')
+            if os.path.basename(filename) == '.gitattributes':
+                files.append((filename, int(mode, 8), sha1))
+        return files
+
+    def _get_attribute_sources(self):
+        """Return the gitattributes files that apply to this commit.
+
+        Return a list of (directory, key, contents) as expected by
+        get_attribute_pathspec()."""
+
+        raise NotImplementedError()
+
+    def get_attribute_sources(self):
+        """Return all of the gitattributes files that apply to this commit.
+
+        Return a list of (directory, key, contents), including those
+        from outside of the tree, as expected by
+        get_attribute_pathspec()."""
+
+        if self._attribute_sources is None:
+            self._attribute_sources = (
+                get_global_attribute_sources() + self._get_attribute_sources()
+                )
+        return self._attribute_sources
+
+    def _make_attribute_source(self, version, key):
+        directory = os.path.dirname(version.filename)
+        if directory:
+            directory += '/'
+        return (directory, key, lambda: version.contents)
+
+    def get_attribute_pathspec(self, attr_names):
+        """Return a pathspec for the files that can have one of attr_names set.
+
+        Return None if the pathspec cannot be determined, in which case
+        all files have to be considered."""
+
+        if not GIT_GLOB_PATHSPEC:
+            return None
+
+        if get_system_attributes_filename() is None:
+            # We can't know what the system-wide file might set:
+            return None
+
+        return get_attribute_pathspec(self.get_attribute_sources(), attr_names)
+
+    def get_attribute_state(self):
+        """Return a SHA1 that identifies the gitattributes files that apply to this commit."""
+
+        if self._attribute_state is None:
+            h = hashlib.sha1()
+            for (directory, key, contents) in self.get_attribute_sources():
+                h.update(repr((directory, key)))
+            self._attribute_state = h.hexdigest()
+
+        return self._attribute_state
 
-        i = iter(words)
+    def _read_diff(self, pathspec=None, pickaxe=None):
+        """Return the NUL-separated words output by the diff command.
+
+        The result is memoized, so that checks that are run
+        separately against the same commit (e.g., in different tiers
+        of the pre-receive checks) share the diff."""
+
+        key = (pathspec and tuple(pathspec), pickaxe)
+        words = self._diffs.get(key)
+        if words is None:
+            options = []
+            if pickaxe is not None:
+                # Let git find the files whose diffs add or remove lines
+                # containing pickaxe (treating binary files as text, so
+                # that they aren't skipped):
+                options += ['-G%s' % (_ere_escape(pickaxe),), '--text']
+            cmd = self._get_diff_command(pathspec, options)
+            p = subprocess.Popen(
+                cmd,
+                stdout=subprocess.PIPE, stderr=subprocess.PIPE,
+                )
+            (out, err) = p.communicate()
+            retcode = p.wait()
+            if retcode or err:
+                sys.exit('Command failed: %s' % (' '.join(cmd),))
+
+            words = out.split('\0')
+            del out
+            words.pop()
+            self._diffs[key] = words
+
+        return words
+
+    def _iter_changes_simple(self, pathspec=None, pickaxe=None):
+        i = iter(self._read_diff(pathspec, pickaxe))
         while True:
             try:
                 prefix = i.next()
@@ -447,6 +1230,21 @@ def _iter_changes_simple(self):
 
     attribute_re = re.compile(r'^(?P<filename>.*): (?P<name>\S+): (?P<value>.*)$')
 
+    def _iter_attribute_output(self, out):
+        """Iterate over (filename, name, value) in the output of "git check-attr -z"."""
+
+        if GIT_CHECK_ATTR_Z_OUTPUT:
+            # The output consists of NUL-terminated fields:
+            words = out.split('\0')
+            words.pop()
+            i = iter(words)
+            for filename in i:
+                yield (filename, i.next(), i.next())
+        else:
+            for line in out.splitlines():
+                m = self.attribute_re.match(line)
+                yield (m.group('filename'), m.group('name'), m.group('value'))
+
     def _get_attributes(self, filenames, attr_names):
         """Return a map {filename : {attribute : value}}."""
 
@@ -463,12 +1261,7 @@ def _get_attributes(self, filenames, attr_names):
 
         attributes = dict((filename, {}) for filename in filenames)
 
-        for line in out.splitlines():
-            m = self.attribute_re.match(line)
-            filename = m.group('filename')
-            name = m.group('name')
-            value = m.group('value')
-
+        for (filename, name, value) in self._iter_attribute_output(out):
             if value == 'unspecified':
                 continue
             elif value == 'unset':
@@ -480,15 +1273,61 @@ def _get_attributes(self, filenames, attr_names):
 
         return attributes
 
-    def iter_changes(self, attr_names):
-        changes = list(self._iter_changes_simple())
+    def _get_memoized_attributes(self, filenames, attr_names):
+        """Return a map {filename : {attribute : value}}, like _get_attributes().
+
+        Only the attributes that haven't been looked up for this
+        commit yet are read from git."""
+
+        missing = [
+            filename
+            for filename in filenames
+            if not (
+                filename in self._attributes
+                and self._attributes[filename][0].issuperset(attr_names)
+                )
+            ]
+        if missing:
+            lookup_names = list(attr_names) + [
+                name
+                for name in self.prefetch_attr_names
+                if name not in attr_names
+                ]
+            for (filename, values) in self._get_attributes(missing, lookup_names).iteritems():
+                (names, known) = self._attributes.setdefault(filename, (set(), {}))
+                names.update(lookup_names)
+                known.update(values)
+
+        attributes = {}
+        for filename in filenames:
+            known = self._attributes[filename][1]
+            attributes[filename] = dict(
+                (name, known[name])
+                for name in attr_names
+                if name in known
+                )
+        return attributes
+
+    def iter_changes(self, attr_names, pathspec_attr_names=None, pickaxe=None):
+        if self.filenames is not None and not self.filenames:
+            # An explicitly empty list of files:
+            return
+
+        pathspec = None
+        if pathspec_attr_names is not None and not (self.filenames or self.limit):
+            pathspec = self.get_attribute_pathspec(pathspec_attr_names)
+            if pathspec == []:
+                # No file can have any of the attributes set:
+                return
+
+        changes = list(self._iter_changes_simple(pathspec, pickaxe))
 
         filenames = [
             change.newfile.filename
             for change in changes
             if change.newfile is not None
             ]
-        attributes = self._get_attributes(filenames, attr_names)
+        attributes = self._get_memoized_attributes(filenames, attr_names)
 
         for change in changes:
             if change.newfile is not None:
@@ -496,35 +1335,281 @@ def iter_changes(self, attr_names):
             yield change
 
 
-class GitIndex(AbstractGitCommit):
-    def __init__(self, filenames=None):
-        AbstractGitCommit.__init__(self, filenames)
+def write_index_tree():
+    """Write the index to a tree and return its SHA1, or None on failure."""
+
+    p = subprocess.Popen(
+        ['git', 'write-tree'],
+        stdout=subprocess.PIPE, stderr=subprocess.PIPE,
+        )
+    (out, err) = p.communicate()
+    retcode = p.wait()
+    if retcode or err:
+        # E.g., there are unmerged entries:
+        return None
+    return out.strip()
+
+
+class GitIndex(AbstractGitCommit):
+    def __init__(self, filenames=None):
+        AbstractGitCommit.__init__(self, filenames)
+
+    def get_tree(self):
+        return write_index_tree()
+
+    def _get_attributes_pipe(self, attr_names):
+        if GIT_CHECK_ATTR_CACHED:
+            cmd = ['git', 'check-attr', '--cached', '-z', '--stdin'] + attr_names + ['--']
+            return subprocess.Popen(
+                cmd,
+                stdin=subprocess.PIPE, stdout=subprocess.PIPE, stderr=subprocess.PIPE,
+                )
+        else:
+            # "git check-attr" doesn't know --cached option; return
+            # options from working copy instead:
+            cmd = ['git', 'check-attr', '-z', '--stdin'] + attr_names + ['--']
+            return subprocess.Popen(
+                cmd,
+                stdin=subprocess.PIPE, stdout=subprocess.PIPE, stderr=subprocess.PIPE,
+                )
+
+    def _get_diff_command(self, pathspec=None, options=[]):
+        return [
+            'git', 'diff-index',
+            '--cached', '--raw', '--no-renames', '-z',
+            ] + options + [
+            self._get_base('HEAD'), '--',
+            ] + self._get_paths(pathspec)
+
+    def _get_attribute_sources(self):
+        return [
+            self._make_attribute_source(ObjectFileVersion(filename, mode, sha1), ('blob', sha1))
+            for (filename, mode, sha1) in self._list_gitattributes_files()
+            ]
+
+    def read_contents(self, filename):
+        cmd = ['git', 'cat-file', 'blob', ':%s' % (filename)]
+        p = subprocess.Popen(
+            cmd,
+            stdout=subprocess.PIPE, stderr=subprocess.PIPE,
+            )
+        (out, err) = p.communicate()
+        retcode = p.wait()
+        if retcode or err:
+            raise MissingContentsException('Command failed: %s' % (' '.join(cmd),))
+
+        return out
+
+
+class IndexCheckCache(object):
+    """Remember the results of checks run against the current index.
+
+    A single "git commit" runs several hooks against the same index.
+    The results of checks are stored under $GIT_DIR, keyed by the stat
+    data and trailing checksum of the index file (which git replaces
+    whenever it changes), HEAD, and the attribute files outside of the
+    tree, so that the later hooks can reuse them (including the
+    warnings that they emitted).  Determining the key doesn't require
+    scanning the index, so a hook whose checks were already run (e.g., by
+    pre-commit, see warm()) doesn't touch the changed files at all."""
+
+    def __init__(self, filename=None):
+        if filename is None:
+            filename = os.path.join(get_nanny_dir(), 'index-checks')
+        self.filename = filename
+        self.key = self._get_index_state()
+        if self.key is None:
+            self.results = {}
+        else:
+            (key, results) = read_cache_file(self.filename, (None, {}))
+            if key == self.key:
+                self.results = results
+            else:
+                self.results = {}
+
+    def _get_index_state(self):
+        """Return a string describing the index state, or None if it can't be determined."""
+
+        index_file = os.environ.get('GIT_INDEX_FILE') or os.path.join(get_git_dir(), 'index')
+        try:
+            f = open(index_file, 'rb')
+            try:
+                st = os.fstat(f.fileno())
+                # The index ends with a checksum of its contents
+                # (unless index.skipHash is set, in which case it is
+                # zero and the stat data have to do):
+                f.seek(max(st.st_size - 20, 0))
+                checksum = f.read()
+            finally:
+                f.close()
+        except (IOError, OSError):
+            return None
+
+        p = subprocess.Popen(
+            ['git', 'rev-parse', '--verify', '-q', 'HEAD'],
+            stdout=subprocess.PIPE, stderr=subprocess.PIPE,
+            )
+        (out, err) = p.communicate()
+        p.wait()
+        state = [
+            os.path.abspath(index_file),
+            repr((st.st_mtime, st.st_ctime, st.st_size, st.st_ino, st.st_dev)),
+            checksum.encode('hex'),
+            out.strip(),
+            ]
+
+        for (directory, key, contents) in get_global_attribute_sources():
+            state.append(hashlib.sha1(contents()).hexdigest())
+
+        return ' '.join(state)
+
+    def _run(self, check, commit, fingerprint, silent=False):
+        metrics.incr('cache_misses', labels=(('cache', 'index-checks'),))
+        (ok, messages, increments) = _run_recorded(check, (commit,), silent=silent)
+        self.results[fingerprint] = (ok, messages, increments)
+        write_cache_file(self.filename, (self.key, self.results))
+        return ok
+
+    def warm(self, check, commit):
+        """Run check(commit) without output, so that later hooks can reuse the result.
+
+        commit should be the same GitIndex object that the other
+        checks were run against, so that the diff and the attribute
+        lookups are shared."""
+
+        if self.key is None:
+            return
+
+        fingerprint = get_check_fingerprint(check)
+        if fingerprint not in self.results:
+            self._run(check, commit, fingerprint, silent=True)
+
+    def __call__(self, check, commit):
+        """Return the result of check(commit), from the cache if possible."""
+
+        if self.key is None:
+            return check(commit)
+
+        fingerprint = get_check_fingerprint(check)
+        try:
+            (ok, messages, increments) = self.results[fingerprint]
+        except KeyError:
+            ok = self._run(check, commit, fingerprint)
+        else:
+            metrics.incr('cache_hits', labels=(('cache', 'index-checks'),))
+            _replay_recorded(messages, increments)
+
+        return ok
+
+
+class StatCache(object):
+    """Remember the results of file checks for unchanged working-tree files.
+
+    Results are stored under $GIT_DIR, keyed by the path of the file,
+    its mtime, ctime, size, inode, and mode (in the same spirit as
+    git's own index), its attributes, the version that it is compared
+    to, and the fingerprint of the check.  A file whose stat data are
+    unchanged is not read again; the warnings that were emitted for it
+    are repeated instead."""
+
+    def __init__(self, filename=None):
+        if filename is None:
+            filename = os.path.join(get_nanny_dir(), 'stat-cache')
+        self.filename = filename
+        self.entries = read_cache_file(self.filename, {})
+        self.fingerprints = set()
+        self.dirty = False
+        self.hits = self.misses = 0
+
+    def _get_key(self, file_change):
+        st = os.lstat(file_change.newfile.filename)
+        if file_change.oldfile is None:
+            old_sha1 = None
+        else:
+            old_sha1 = file_change.oldfile.sha1
+        return (
+            st.st_mtime, st.st_ctime, st.st_size, st.st_ino, st.st_mode,
+            tuple(sorted(file_change.newfile.attributes.items())),
+            old_sha1,
+            )
+
+    def __call__(self, file_check, fingerprint, file_change):
+        """Return the result of file_check(file_change), from the cache if possible.
+
+        fingerprint is the result of get_check_fingerprint(file_check)."""
+
+        if file_change.newfile is None:
+            return file_check(file_change)
+
+        filename = file_change.newfile.filename
+        try:
+            key = self._get_key(file_change)
+        except OSError:
+            return file_check(file_change)
+
+        self.fingerprints.add(fingerprint)
+        entry = self.entries.get((fingerprint, filename))
+        if entry is not None and entry[0] == key:
+            self.hits += 1
+            metrics.incr('cache_hits', labels=(('cache', 'stat'),))
+            (key, ok, messages, increments) = entry
+            _replay_recorded(messages, increments)
+            return ok
+
+        self.misses += 1
+        metrics.incr('cache_misses', labels=(('cache', 'stat'),))
+        (ok, messages, increments) = _run_recorded(file_check, (file_change,))
+
+        self.entries[(fingerprint, filename)] = (key, ok, messages, increments)
+        self.dirty = True
+        return ok
+
+    def save(self):
+        """Write the cache back to disk if it has changed.
+
+        Entries for files that no longer exist or for checks that
+        were not used during this run are dropped."""
+
+        if not self.dirty:
+            return
+
+        for (fingerprint, filename) in self.entries.keys():
+            if fingerprint not in self.fingerprints or not os.path.lexists(filename):
+                del self.entries[(fingerprint, filename)]
+
+        write_cache_file(self.filename, self.entries)
+
+        # Like git, don't trust the stat data of files that are not
+        # older than the cache file (according to the filesystem's own
+        # clock): a later change within the same timestamp tick could
+        # leave their stat data unchanged.  Such "racily clean" entries
+        # are dropped:
+        timestamp = os.stat(self.filename).st_mtime
+        racy = [
+            name
+            for (name, entry) in self.entries.iteritems()
+            if entry[0][0] >= timestamp
+            ]
+        if racy:
+            for name in racy:
+                del self.entries[name]
+            write_cache_file(self.filename, self.entries)
+
+        self.dirty = False
+
 
-    def _get_attributes_pipe(self, attr_names):
-        if GIT_CHECK_ATTR_CACHED:
-            cmd = ['git', 'check-attr', '--cached', '-z', '--stdin'] + attr_names + ['--']
-            return subprocess.Popen(
-                cmd,
-                stdin=subprocess.PIPE, stdout=subprocess.PIPE, stderr=subprocess.PIPE,
-                )
-        else:
-            # "git check-attr" doesn't know --cached option; return
-            # options from working copy instead:
-            cmd = ['git', 'check-attr', '-z', '--stdin'] + attr_names + ['--']
-            return subprocess.Popen(
-                cmd,
-                stdin=subprocess.PIPE, stdout=subprocess.PIPE, stderr=subprocess.PIPE,
-                )
+class GitWorkingTree(AbstractGitCommit):
+    def __init__(self, filenames=None, stat_cache=None, limit=None):
+        AbstractGitCommit.__init__(self, filenames, limit=limit)
+        self.file_check_cache = stat_cache
 
-    def _get_diff_command(self):
-        return [
-            'git', 'diff-index',
-            '--cached', '--raw', '--no-renames', '-z',
-            self._get_base('HEAD'), '--',
-            ] + (self.filenames or [])
+    def get_tree(self):
+        # The files that are unchanged relative to the index have the
+        # contents recorded in the index's tree (see get_dirty_paths()):
+        return write_index_tree()
 
-    def read_contents(self, filename):
-        cmd = ['git', 'cat-file', 'blob', ':%s' % (filename)]
+    def get_dirty_paths(self):
+        cmd = ['git', 'diff-files', '--name-only', '-z']
         p = subprocess.Popen(
             cmd,
             stdout=subprocess.PIPE, stderr=subprocess.PIPE,
@@ -532,14 +1617,8 @@ def read_contents(self, filename):
         (out, err) = p.communicate()
         retcode = p.wait()
         if retcode or err:
-            raise MissingContentsException('Command failed: %s' % (' '.join(cmd),))
-
-        return out
-
-
-class GitWorkingTree(AbstractGitCommit):
-    def __init__(self, filenames=None):
-        AbstractGitCommit.__init__(self, filenames)
+            sys.exit('Command failed: %s' % (' '.join(cmd),))
+        return [path for path in out.split('\0') if path]
 
     def _get_attributes_pipe(self, attr_names):
         cmd = ['git', 'check-attr', '-z', '--stdin'] + attr_names + ['--']
@@ -548,12 +1627,54 @@ def _get_attributes_pipe(self, attr_names):
             stdin=subprocess.PIPE, stdout=subprocess.PIPE, stderr=subprocess.PIPE,
             )
 
-    def _get_diff_command(self):
+    def _get_diff_command(self, pathspec=None, options=[]):
         return [
             'git', 'diff-index',
             '--raw', '--no-renames', '-z',
+            ] + options + [
             self._get_base('HEAD'), '--',
-            ] + (self.filenames or [])
+            ] + self._get_paths(pathspec)
+
+    def _get_attribute_sources(self):
+        # "git check-attr" reads the .gitattributes files from the
+        # working tree, falling back to the index:
+        sources = []
+        for (filename, mode, sha1) in self._list_gitattributes_files():
+            try:
+                contents = self.read_contents(filename)
+            except MissingContentsException:
+                version = ObjectFileVersion(filename, mode, sha1)
+                sources.append(self._make_attribute_source(version, ('blob', sha1)))
+            else:
+                version = CommitFileVersion(self, filename, mode)
+                version._contents = contents
+                sources.append(self._make_attribute_source(version, ('file', contents)))
+
+        # It also reads untracked (even ignored) .gitattributes files:
+        cmd = [
+            'git', 'ls-files', '--others', '--full-name', '-z',
+            '--', ':(top,glob)**/.gitattributes',
+            ]
+        p = subprocess.Popen(
+            cmd,
+            stdout=subprocess.PIPE, stderr=subprocess.PIPE,
+            )
+        (out, err) = p.communicate()
+        retcode = p.wait()
+        if retcode or err:
+            sys.exit('Command failed: %s' % (' '.join(cmd),))
+        for filename in out.split('\0'):
+            if os.path.basename(filename) != '.gitattributes':
+                continue
+            try:
+                contents = self.read_contents(filename)
+            except MissingContentsException:
+                continue
+            version = CommitFileVersion(self, filename, 0100644)
+            version._contents = contents
+            sources.append(self._make_attribute_source(version, ('file', contents)))
+
+        return sources
 
     def read_contents(self, filename):
         try:
@@ -566,13 +1687,24 @@ def read_contents(self, filename):
 
 
 class GitCommit(AbstractGitCommit):
-    def __init__(self, sha1, filenames=None):
-        AbstractGitCommit.__init__(self, filenames)
+    def __init__(self, sha1, filenames=None, base=None, limit=None):
+        """A commit, compared to its first parent or to base.
+
+        If base is specified, the net changes from base to sha1 are
+        checked (in a single diff), using the gitattributes of sha1."""
+
+        AbstractGitCommit.__init__(self, filenames, limit=limit)
         self.sha1 = sha1
+        self.base = base
         self.indexfile = None
         self._metadata = None
 
     def __del__(self):
+        self.release_index()
+
+    def release_index(self):
+        """Remove the temporary index file, if any (it is recreated if needed)."""
+
         if self.indexfile:
             os.remove(self.indexfile)
             self.indexfile = None
@@ -582,6 +1714,18 @@ def get_metadata(self):
             self._metadata = GitCommitMetadata(self.sha1)
         return self._metadata
 
+    def get_tree(self):
+        cmd = ['git', 'rev-parse', '--verify', '%s^{tree}' % (self.sha1,)]
+        p = subprocess.Popen(
+            cmd,
+            stdout=subprocess.PIPE, stderr=subprocess.PIPE,
+            )
+        (out, err) = p.communicate()
+        retcode = p.wait()
+        if retcode or err:
+            sys.exit('Command failed: %s' % (' '.join(cmd),))
+        return out.strip()
+
     def get_indexfile(self):
         if self.indexfile is None:
             (fd, self.indexfile) = tempfile.mkstemp(suffix='.index', prefix=self.sha1[:10])
@@ -615,14 +1759,27 @@ def _get_attributes_pipe(self, attr_names):
                 stdin=subprocess.PIPE, stdout=subprocess.PIPE, stderr=subprocess.PIPE,
                 )
 
-    def _get_diff_command(self):
+    def _get_diff_command(self, pathspec=None, options=[]):
         return [
             'git', 'diff-tree',
             '-r', '--raw', '--no-renames', '-z',
-            self._get_base('%s^' % (self.sha1,)), self.sha1, '--',
-            ] + (self.filenames or [])
+            ] + options + [
+            self._get_base(self.base or '%s^' % (self.sha1,)), self.sha1, '--',
+            ] + self._get_paths(pathspec)
+
+    def _get_attribute_sources(self):
+        env = os.environ.copy()
+        env['GIT_INDEX_FILE'] = self.get_indexfile()
+        return [
+            self._make_attribute_source(ObjectFileVersion(filename, mode, sha1), ('blob', sha1))
+            for (filename, mode, sha1) in self._list_gitattributes_files(env=env)
+            ]
 
     def read_contents(self, filename):
+        out = read_object(git_objects.ObjectDatabase.read_path, self.sha1, filename)
+        if out is not None:
+            return out
+
         cmd = ['git', 'cat-file', 'blob', '%s:%s' % (self.sha1, filename)]
         p = subprocess.Popen(
             cmd,
@@ -636,12 +1793,496 @@ def read_contents(self, filename):
         return out
 
 
+def list_tree(tree):
+    """List the subtrees and blobs within tree, recursively.
+
+    Return (trees, blobs), where trees is a map {path : sha1} for
+    tree and all of its subtrees (tree itself having path '') and
+    blobs is a list of the paths of all other entries."""
+
+    cmd = ['git', 'ls-tree', '-r', '-t', '-z', '--full-tree', tree]
+    p = subprocess.Popen(
+        cmd,
+        stdout=subprocess.PIPE, stderr=subprocess.PIPE,
+        )
+    (out, err) = p.communicate()
+    retcode = p.wait()
+    if retcode or err:
+        sys.exit('Command failed: %s' % (' '.join(cmd),))
+
+    trees = {'' : tree}
+    blobs = []
+    for entry in out.split('\0'):
+        if not entry:
+            continue
+        (info, path) = entry.split('\t', 1)
+        (mode, type, sha1) = info.split(' ')
+        if type == 'tree':
+            trees[path] = sha1
+        else:
+            blobs.append(path)
+
+    return (trees, blobs)
+
+
+def _iter_parent_dirs(path):
+    """Iterate over the directories containing path, from the innermost to ''."""
+
+    while path:
+        path = os.path.dirname(path)
+        yield path
+
+
+class CleanTreeCache(object):
+    """Remember which trees passed a check, so that they needn't be checked again.
+
+    Entries are keyed by the path and SHA1 of the tree, the state of
+    the gitattributes files, and the fingerprint of the check, and
+    are stored in $GIT_DIR/nanny/clean-trees.  This is meant for
+    checking a list of files (e.g., "check-format --all") as if they
+    were newly added: files within subtrees that are known to be clean
+    are omitted from the list, so the cost is proportional to the
+    size of the subtrees that changed."""
+
+    MAX_ENTRIES = 200000
+
+    def __init__(self, check, filename=None):
+        if filename is None:
+            filename = os.path.join(get_nanny_dir(), 'clean-trees')
+        self.filename = filename
+        self.fingerprint = get_check_fingerprint(check)
+        self.entries = read_cache_file(self.filename, {})
+        self.dirty = False
+        self._keys = None
+        self._unchecked = None
+
+    def _get_key(self, path, sha1, attribute_state):
+        return hashlib.sha1(
+            '%s %s %s %s' % (sha1, attribute_state, self.fingerprint, path)
+            ).digest()
+
+    def prune(self, commit, filenames):
+        """Return the files among filenames that are not within known-clean trees.
+
+        Also remember the state needed to record the clean trees of
+        commit afterwards (see record())."""
+
+        self._keys = None
+        tree = commit.get_tree()
+        if tree is None:
+            return filenames
+
+        (trees, blobs) = list_tree(tree)
+        attribute_state = commit.get_attribute_state()
+
+        # Trees containing paths whose contents might not match tree
+        # can be neither used nor recorded:
+        unusable = set()
+        for path in commit.get_dirty_paths():
+            unusable.update(_iter_parent_dirs(path))
+
+        self._keys = {}
+        for (path, sha1) in trees.iteritems():
+            if path not in unusable:
+                self._keys[path] = self._get_key(path, sha1, attribute_state)
+
+        clean = set(path for (path, key) in self._keys.iteritems() if key in self.entries)
+        metrics.incr('cache_hits', len(clean), labels=(('cache', 'clean-trees'),))
+        metrics.incr('cache_misses', len(self._keys) - len(clean), labels=(('cache', 'clean-trees'),))
+
+        def is_clean(path):
+            for d in _iter_parent_dirs(path):
+                if d in clean:
+                    return True
+            return False
+
+        # Files that are not in tree (e.g., untracked files) have to be
+        # checked regardless:
+        in_tree = set(blobs)
+        remaining = [
+            filename
+            for filename in filenames
+            if filename not in in_tree or not is_clean(filename)
+            ]
+
+        # The files that are neither within clean trees nor checked
+        # now; the trees containing them mustn't be recorded:
+        self._unchecked = set(blob for blob in blobs if not is_clean(blob))
+        self._unchecked.difference_update(remaining)
+
+        return remaining
+
+    def record(self, commit):
+        """Remember the trees of commit that contain no failed or unchecked files."""
+
+        if self._keys is None:
+            return
+
+        unclean = set()
+        for path in commit.failed_filenames | self._unchecked:
+            unclean.update(_iter_parent_dirs(path))
+
+        now = time.time()
+        for (path, key) in self._keys.iteritems():
+            if path not in unclean:
+                self.entries[key] = now
+                self.dirty = True
+
+        self._keys = None
+
+    def save(self):
+        if not self.dirty:
+            return
+
+        if len(self.entries) > self.MAX_ENTRIES:
+            # Forget the oldest entries:
+            keys = sorted(self.entries, key=self.entries.get)
+            for key in keys[:len(keys) - self.MAX_ENTRIES]:
+                del self.entries[key]
+
+        write_cache_file(self.filename, self.entries)
+        self.dirty = False
+
+
+class BlobCheckCache(object):
+    """Remember the results of file checks for the files in commits.
+
+    Results are keyed by the path of the file, the SHA1 and mode of
+    its new version, its attributes, and the fingerprint of the check
+    (plus the SHA1 of the old version, for checks that look at it; see
+    Check.uses_old_version()).  A commit that was rebased or
+    cherry-picked usually contains the same blobs as the original, so
+    its files needn't be checked again; the warnings that were emitted
+    for them are repeated instead.  Results are stored in
+    $GIT_DIR/nanny/blob-checks."""
+
+    MAX_ENTRIES = 200000
+
+    # How old (in seconds) the timestamp of an entry must be before a
+    # cache hit refreshes it.  Refreshing it only coarsely means that
+    # pushes whose files are all cache hits don't rewrite the file.
+    REFRESH_INTERVAL = 24 * 60 * 60
+
+    def __init__(self, filename=None):
+        if filename is None:
+            filename = os.path.join(get_nanny_dir(), 'blob-checks')
+        self.filename = filename
+        self.entries = read_cache_file(self.filename, {})
+        # The entries that were added or refreshed since the file was
+        # read, to be merged into the file by save():
+        self.updates = {}
+
+    def _get_key(self, file_check, fingerprint, file_change):
+        newfile = file_change.newfile
+        old_sha1 = None
+        if file_check.uses_old_version() and file_change.oldfile is not None:
+            old_sha1 = file_change.oldfile.sha1
+        return hashlib.sha1(repr((
+            newfile.filename, newfile.sha1, newfile.mode,
+            sorted(newfile.attributes.items()),
+            old_sha1, fingerprint,
+            ))).digest()
+
+    def __call__(self, file_check, fingerprint, file_change):
+        """Return the result of file_check(file_change), from the cache if possible.
+
+        fingerprint is the result of get_check_fingerprint(file_check)."""
+
+        if getattr(file_change.newfile, 'sha1', None) is None:
+            return file_check(file_change)
+
+        key = self._get_key(file_check, fingerprint, file_change)
+        entry = self.entries.get(key)
+        if entry is not None:
+            metrics.incr('cache_hits', labels=(('cache', 'blob'),))
+            (ok, messages, timestamp, increments) = entry
+            _replay_recorded(messages, increments)
+            now = time.time()
+            if now - timestamp > self.REFRESH_INTERVAL:
+                self.entries[key] = self.updates[key] = (ok, messages, now, increments)
+            return ok
+
+        metrics.incr('cache_misses', labels=(('cache', 'blob'),))
+        (ok, messages, increments) = _run_recorded(file_check, (file_change,))
+        self.entries[key] = self.updates[key] = (ok, messages, time.time(), increments)
+        return ok
+
+    def _lock(self):
+        dirname = os.path.dirname(os.path.abspath(self.filename))
+        if not os.path.isdir(dirname):
+            os.makedirs(dirname)
+        lock = open(self.filename + '.lock', 'a')
+        fcntl.flock(lock.fileno(), fcntl.LOCK_EX)
+        return lock
+
+    def save(self):
+        """Merge the new entries into the file, if there are any.
+
+        The file is re-read under a lock, so that entries that were
+        saved by concurrent pushes in the meantime are kept."""
+
+        if not self.updates:
+            return
+
+        lock = self._lock()
+        try:
+            entries = read_cache_file(self.filename, {})
+            entries.update(self.updates)
+            if len(entries) > self.MAX_ENTRIES:
+                # Forget the least recently used entries:
+                keys = sorted(entries, key=lambda key: entries[key][2])
+                for key in keys[:len(keys) - self.MAX_ENTRIES]:
+                    del entries[key]
+
+            write_cache_file(self.filename, entries)
+        finally:
+            lock.close()
+        self.entries = entries
+        self.updates = {}
+
+
+def _read_module_source():
+    f = open(os.path.splitext(__file__)[0] + '.py', 'rb')
+    source = f.read()
+    f.close()
+    return source
+
+
+_module_digest = None
+
+
+def _fingerprint_value(value):
+    if isinstance(value, Check):
+        return value.get_fingerprint()
+    elif isinstance(value, (list, tuple)):
+        return '[%s]' % (', '.join([_fingerprint_value(v) for v in value]),)
+    elif hasattr(value, 'pattern') and hasattr(value, 'flags'):
+        # A compiled regular expression:
+        return 're(%r, %d)' % (value.pattern, value.flags)
+    else:
+        return repr(value)
+
+
+def get_check_fingerprint(check):
+    """Return a SHA1 that identifies check and the code implementing it.
+
+    The fingerprint changes whenever the configuration of check or
+    the source code of this module changes, so it can be used as part
+    of the key for cached check results."""
+
+    global _module_digest
+
+    if _module_digest is None:
+        _module_digest = hashlib.sha1(_read_module_source()).hexdigest()
+
+    return hashlib.sha1(_module_digest + check.get_fingerprint()).hexdigest()
+
+
+def find_missing_objects(sha1s):
+    """Return the list of the objects in sha1s that are not in the repository."""
+
+    cmd = ['git', 'cat-file', '--batch-check']
+    p = subprocess.Popen(cmd, stdin=subprocess.PIPE, stdout=subprocess.PIPE)
+    (out, err) = p.communicate(''.join(['%s\n' % (sha1,) for sha1 in sha1s]))
+    retcode = p.wait()
+    if retcode:
+        sys.exit('Command failed: %s' % (' '.join(cmd),))
+    return [line.split()[0] for line in out.splitlines() if line.endswith(' missing')]
+
+
+def get_verification_fingerprint(check):
+    """Return a SHA1 identifying the result of check for any given commit.
+
+    Besides the fingerprint of check, this covers the gitattributes
+    files that are not part of the commit, because they may differ
+    from one repository to the next."""
+
+    h = hashlib.sha1(get_check_fingerprint(check))
+    for (directory, key, contents) in get_global_attribute_sources():
+        h.update(' %s' % (hashlib.sha1(contents()).hexdigest(),))
+    return h.hexdigest()
+
+
+NOTES_REF = 'refs/notes/nanny'
+
+
+class VerificationNotes(object):
+    """Publish and look up the commits that passed a check, as git notes.
+
+    The note for a commit lists the verification fingerprints (see
+    get_verification_fingerprint()) of the checks that it passed.
+    Commits are first added to a pending file in $GIT_DIR/nanny, then
+    written to the notes ref in bulk by publish_pending(); this allows
+    the pre-receive hook, which may not update references, to record
+    results that are published by the post-receive hook."""
+
+    def __init__(self, check, ref=NOTES_REF):
+        self.ref = ref
+        self.fingerprint = get_verification_fingerprint(check)
+        self.pending_filename = os.path.join(get_nanny_dir(), 'notes-pending')
+
+    def read_notes(self, sha1s):
+        """Return {sha1 : set(fingerprints)} for those of sha1s that have notes."""
+
+        if not sha1s:
+            return {}
+
+        cmd = [
+            'git', 'log', '--no-walk=unsorted', '--stdin',
+            '--notes=%s' % (self.ref,), '--format=%H %N%x00',
+            ]
+        p = subprocess.Popen(
+            cmd, stdin=subprocess.PIPE, stdout=subprocess.PIPE, stderr=subprocess.PIPE,
+            )
+        (out, err) = p.communicate(''.join(['%s\n' % (sha1,) for sha1 in sha1s]))
+        retcode = p.wait()
+        if retcode:
+            sys.exit('Command failed: %s' % (' '.join(cmd),))
+
+        notes = {}
+        for record in out.split('\0'):
+            words = record.split()
+            if len(words) > 1:
+                notes[words[0]] = set(words[1:])
+        return notes
+
+    def get_verified(self, sha1s):
+        """Return the set of the commits in sha1s that are known to pass the check."""
+
+        verified = set(
+            sha1
+            for (sha1, fingerprints) in self.read_notes(sha1s).iteritems()
+            if self.fingerprint in fingerprints
+            )
+        metrics.incr('cache_hits', len(verified), labels=(('cache', 'notes'),))
+        metrics.incr('cache_misses', len(sha1s) - len(verified), labels=(('cache', 'notes'),))
+        return verified
+
+    def _lock(self):
+        if not os.path.isdir(os.path.dirname(self.pending_filename)):
+            os.makedirs(os.path.dirname(self.pending_filename))
+        lock = open(self.pending_filename + '.lock', 'a')
+        fcntl.flock(lock.fileno(), fcntl.LOCK_EX)
+        return lock
+
+    def add_pending(self, sha1s):
+        """Remember that the commits sha1s passed the check, to be published later."""
+
+        if not sha1s:
+            return
+
+        lock = self._lock()
+        try:
+            f = open(self.pending_filename, 'a')
+            f.write(''.join(['%s %s\n' % (sha1, self.fingerprint) for sha1 in sha1s]))
+            f.close()
+        finally:
+            lock.close()
+
+    def publish_pending(self):
+        """Write the pending results for existing commits to the notes ref.
+
+        Results for commits that don't exist (e.g., because the push
+        that they were part of was rejected after all) are discarded.
+        Return the number of commits whose notes were updated."""
+
+        lock = self._lock()
+        try:
+            try:
+                f = open(self.pending_filename)
+            except IOError:
+                return 0
+            pending = {}
+            for line in f:
+                (sha1, fingerprint) = line.split()
+                pending.setdefault(sha1, set()).add(fingerprint)
+            f.close()
+
+            for sha1 in find_missing_objects(sorted(pending)):
+                del pending[sha1]
+
+            notes = self.read_notes(sorted(pending))
+            updates = []
+            for (sha1, fingerprints) in sorted(pending.iteritems()):
+                old = notes.get(sha1, set())
+                if not fingerprints <= old:
+                    updates.append((sha1, old | fingerprints))
+
+            if updates:
+                self._write_notes(updates)
+            os.remove(self.pending_filename)
+            return len(updates)
+        finally:
+            lock.close()
+
+    def _write_notes(self, updates):
+        """Write notes for updates, a list of (sha1, fingerprints), in a single commit."""
+
+        p = subprocess.Popen(
+            ['git', 'rev-parse', '--verify', '-q', self.ref],
+            stdout=subprocess.PIPE, stderr=subprocess.PIPE,
+            )
+        (out, err) = p.communicate()
+        retcode = p.wait()
+        parent = (not retcode) and out.strip() or None
+
+        message = 'Record commits verified by git-nanny\n'
+        commands = [
+            'commit %s\n' % (self.ref,),
+            'committer git-nanny <git-nanny> %d +0000\n' % (time.time(),),
+            'data %d\n%s' % (len(message), message),
+            ]
+        if parent is not None:
+            commands.append('from %s\n' % (parent,))
+        for (sha1, fingerprints) in updates:
+            note = ''.join(['%s\n' % (fingerprint,) for fingerprint in sorted(fingerprints)])
+            commands.append('N inline %s\ndata %d\n%s' % (sha1, len(note), note))
+        commands.append('\n')
+
+        cmd = ['git', 'fast-import', '--quiet']
+        p = subprocess.Popen(cmd, stdin=subprocess.PIPE)
+        p.communicate(''.join(commands))
+        retcode = p.wait()
+        if retcode:
+            sys.exit('Command failed: %s' % (' '.join(cmd),))
+
+
 class Check(object):
+    def get_fingerprint(self):
+        """Return a string that describes the configuration of this Check.
+
+        The default implementation describes the class name and the
+        values of all instance attributes whose names don't start with
+        '_'."""
+
+        return '%s(%s)' % (
+            self.__class__.__name__,
+            ', '.join([
+                '%s=%s' % (name, _fingerprint_value(value))
+                for (name, value) in sorted(vars(self).items())
+                if not name.startswith('_')
+                ]),
+            )
+
     def get_needed_attribute_names(self):
         """Return an iterable of names of attributes that this Check relies on."""
 
         return []
 
+    def uses_old_version(self):
+        """Return True iff the result of this Check depends on the old version of the file."""
+
+        return False
+
+    def get_trigger_attribute_names(self):
+        """Return the names of attributes without which this Check passes.
+
+        Return an iterable of attribute names such that this Check is
+        guaranteed to return True for any file that has none of them
+        set, or None if no such guarantee can be given."""
+
+        return None
+
     def __invert__(self):
         """The inverse of the original check.
 
@@ -673,6 +2314,16 @@ def __init__(self, check):
     def get_needed_attribute_names(self):
         return self.check.get_needed_attribute_names()
 
+    def uses_old_version(self):
+        return self.check.uses_old_version()
+
+    def get_trigger_attribute_names(self):
+        if isinstance(self.check, AttributeSetCheck):
+            # The inverse is True whenever the attribute is not set:
+            return [self.check.property]
+
+        return None
+
     def __call__(self, *args, **kw):
         return not self.check(*args, **kw)
 
@@ -691,6 +2342,24 @@ def get_needed_attribute_names(self):
                 ]
             )
 
+    def uses_old_version(self):
+        for check in self.checks:
+            if check.uses_old_version():
+                return True
+
+        return False
+
+    def get_trigger_attribute_names(self):
+        # By default, all of the checks have to pass:
+        names = set()
+        for check in self.checks:
+            check_names = check.get_trigger_attribute_names()
+            if check_names is None:
+                return None
+            names.update(check_names)
+
+        return names
+
 
 class CheckAnd(_CompoundCheck):
     """A check that is the logical 'and' of other checks.
@@ -714,6 +2383,15 @@ class CheckOr(_CompoundCheck):
 
     """
 
+    def get_trigger_attribute_names(self):
+        # It suffices for any one of the checks to pass:
+        for check in self.checks:
+            check_names = check.get_trigger_attribute_names()
+            if check_names is not None:
+                return check_names
+
+        return None
+
     def __call__(self, *args, **kw):
         for check in self.checks:
             if check(*args, **kw):
@@ -772,32 +2450,76 @@ def __call__(self, commit, silent=False):
 class LogMarkerStringCheck(MetadataCheck):
     """Don't allow a log message that includes the marker string."""
 
+    error_summary = 'log messages containing the marker string'
+
     def __call__(self, metadata, silent=False):
         ok = MARKER_STRING not in metadata.logmsg
+        if not ok:
+            metrics.incr('check_failures', labels=(('check', self.__class__.__name__),))
         if not ok and not silent:
-            reporter.warning('Log message contains marker string ("%s")' % (MARKER_STRING,))
+            reporter.warning(
+                'Log message contains marker string ("%s")' % (MARKER_STRING,),
+                self.error_summary,
+                )
         return ok
 
 
 class FileCheck(Check):
     """A Check applied to a single file."""
 
+    # A description of the files that fail this check (e.g., 'files
+    # with tabs'), used to summarize warnings that were suppressed:
+    error_summary = None
+
     def __call__(self, file_change):
         raise NotImplementedError()
 
 
 class FileCheckAdapter(CommitCheck):
-    """A CommitCheck that is a MultipleCheck over FileChecks."""
+    """A CommitCheck that is a MultipleCheck over FileChecks.
 
-    def __init__(self, *file_checks):
+    If the keyword argument pickaxe is set to a string, only files
+    whose diffs add or remove a line containing that string are
+    checked.  This lets git do most of the work when the file checks
+    can only fail for such files (e.g., NewMarkerStringCheck)."""
+
+    def __init__(self, *file_checks, **kw):
         self.file_check = MultipleCheck(*file_checks)
+        self.pickaxe = kw.pop('pickaxe', None)
+        if kw:
+            raise TypeError('Unexpected keyword arguments: %s' % (', '.join(kw),))
+        self._fingerprint = None
+
+    def get_needed_attribute_names(self):
+        return self.file_check.get_needed_attribute_names()
 
     def __call__(self, commit, silent=False):
         attr_names = list(self.file_check.get_needed_attribute_names())
+        pathspec_attr_names = self.file_check.get_trigger_attribute_names()
+        if pathspec_attr_names is not None:
+            pathspec_attr_names = list(pathspec_attr_names)
+
+        cache = commit.file_check_cache
+        if cache is not None:
+            if self._fingerprint is None:
+                self._fingerprint = get_check_fingerprint(self.file_check)
+            fingerprint = self._fingerprint
 
         ok = True
-        for file_change in commit.iter_changes(attr_names=attr_names):
-            ok &= bool(self.file_check(file_change))
+        for file_change in commit.iter_changes(
+                attr_names=attr_names, pathspec_attr_names=pathspec_attr_names,
+                pickaxe=self.pickaxe,
+                ):
+            if commit.deadline is not None and time.time() > commit.deadline:
+                raise DeadlineExceeded()
+            metrics.incr('files_checked')
+            if cache is None:
+                file_ok = bool(self.file_check(file_change))
+            else:
+                file_ok = bool(cache(self.file_check, fingerprint, file_change))
+            if not file_ok:
+                commit.failed_filenames.add((file_change.newfile or file_change.oldfile).filename)
+            ok &= file_ok
 
         return ok
 
@@ -805,13 +2527,20 @@ def __call__(self, commit, silent=False):
 class NewLinesCheck(FileCheck):
     """A Check that is purely based on the lines added to the file."""
 
+    def uses_old_version(self):
+        return True
+
     def __call__(self, file_change):
         ok = True
         for (lineno, line) in file_change.new_lines:
             ok &= bool(self.check_line(lineno, line))
 
         if not ok:
-            reporter.warning(self.error_fmt % {'filename' : file_change.newfile.filename})
+            metrics.incr('check_failures', labels=(('check', self.__class__.__name__),))
+            reporter.warning(
+                self.error_fmt % {'filename' : file_change.newfile.filename},
+                self.error_summary,
+                )
 
         return ok
 
@@ -828,7 +2557,11 @@ def __call__(self, file_change):
         ok = file_change.newfile is None or self.check_text(file_change.newfile.contents)
 
         if not ok:
-            reporter.warning(self.error_fmt % {'filename' : file_change.newfile.filename})
+            metrics.incr('check_failures', labels=(('check', self.__class__.__name__),))
+            reporter.warning(
+                self.error_fmt % {'filename' : file_change.newfile.filename},
+                self.error_summary,
+                )
 
         return ok
 
@@ -839,23 +2572,34 @@ def check_text(self, text):
 
 
 class TrailingWhitespaceCheck(TextCheck):
-    """Don't allow whitespace at the end of a line or the end of the file."""
+    """Don't allow whitespace at the end of a line or the end of the file.
 
-    trailing_ws_re = re.compile(r'[ \t]+$', re.MULTILINE)
+    This is equivalent to searching for the regexp r'[ \t]+$' in
+    MULTILINE mode, but substring searches are guaranteed to take time
+    linear in the length of the text, whereas the regexp backtracks
+    quadratically on long runs of blanks that are not at the end of a
+    line."""
 
     error_fmt = 'Trailing whitespace in %(filename)s'
+    error_summary = 'files with trailing whitespace'
 
     def __init__(self):
         pass
 
     def check_text(self, text):
-        return not self.trailing_ws_re.search(text)
+        return not (
+            ' \n' in text
+            or '\t\n' in text
+            or text.endswith(' ')
+            or text.endswith('\t')
+            )
 
 
 class TabCheck(TextCheck):
     """Don't allow any tab characters."""
 
     error_fmt = 'Tab(s) in %(filename)s'
+    error_summary = 'files with tabs'
 
     def check_text(self, text):
         return text.find('\t') == -1
@@ -865,6 +2609,7 @@ class CRCheck(TextCheck):
     """Don't allow any carriage returns characters."""
 
     error_fmt = 'Carriage return(s) in %(filename)s'
+    error_summary = 'files with carriage returns'
 
     def check_text(self, text):
         return text.find('\r') == -1
@@ -874,6 +2619,7 @@ class UnterminatedLineCheck(TextCheck):
     """Don't allow the last line to be unterminated."""
 
     error_fmt = 'Last line of %(filename)s is unterminated'
+    error_summary = 'files with an unterminated last line'
 
     def check_text(self, text):
         return (not text) or text[-1] == '\n'
@@ -890,6 +2636,7 @@ class MarkerStringCheck(TextCheck):
     error_fmt = 'Marker string ("%s") found in %%(filename)s' % (
         MARKER_STRING,
         )
+    error_summary = 'files containing the marker string'
 
     def check_text(self, text):
         return MARKER_STRING not in text
@@ -901,11 +2648,173 @@ class NewMarkerStringCheck(NewLinesCheck):
     error_fmt = 'Marker string ("%s") added to %%(filename)s' % (
         MARKER_STRING,
         )
+    error_summary = 'files with the marker string added'
 
     def check_line(self, lineno, line):
         return MARKER_STRING not in line
 
 
+def _literal_alternation(strings):
+    """Return a regexp pattern that matches any of strings.
+
+    The alternatives are factored by their common prefixes (i.e., the
+    pattern is a trie), so that the regexp engine doesn't have to try
+    each string separately at each position."""
+
+    trie = {}
+    for string in strings:
+        node = trie
+        for c in string:
+            node = node.setdefault(c, {})
+        node[''] = {}
+
+    def build(node):
+        branches = [
+            re.escape(c) + build(child)
+            for (c, child) in sorted(node.items())
+            if c
+            ]
+        if not branches:
+            return ''
+        elif len(branches) == 1 and '' not in node:
+            return branches[0]
+        pattern = '(?:%s)' % ('|'.join(branches),)
+        if '' in node:
+            # A shorter string ends here:
+            pattern += '?'
+        return pattern
+
+    return build(trie)
+
+
+class ForbiddenStringCheck(TextCheck):
+    """Don't allow files that contain any of a set of forbidden strings.
+
+    strings is a list of literal strings and patterns a list of
+    regular expressions.  If they are not specified, they are read
+    from the multi-valued git configuration settings
+    nanny.forbiddenString and nanny.forbiddenPattern, respectively;
+    settings without a value, empty strings, and patterns that are
+    invalid or that match the empty string are reported as a
+    ConfigError.
+
+    The strings and patterns are compiled into a single regular
+    expression, so that each file is scanned only once regardless of
+    how many there are.  Patterns that contain inline flags such as
+    '(?i)' (which would apply to the whole expression) or capturing
+    groups (whose numbers would change) are scanned for separately.
+    Matches can overlap, so if anything is found, the file is
+    rescanned for each string and pattern separately in order to
+    report all of them."""
+
+    error_fmt = 'Forbidden string %(pattern)r found in %(filename)s'
+    error_summary = 'forbidden strings'
+
+    def __init__(self, strings=None, patterns=None):
+        self._strings = strings
+        self._patterns = patterns
+        self._regexp = None
+
+    def _read_config(self, name, display_name):
+        values = get_config_all(name)
+        for value in values:
+            if value is None:
+                raise ConfigError('%s requires a value' % (display_name,))
+            elif not value:
+                raise ConfigError(
+                    'Invalid value for %s: %r (it would match every file)'
+                    % (display_name, value,)
+                    )
+        return values
+
+    def _compile(self):
+        """Read the configuration (if necessary) and compile the regexps.
+
+        Raise ConfigError if a configured string or pattern is invalid
+        or would match every file."""
+
+        if self._strings is None:
+            self._strings = self._read_config('nanny.forbiddenstring', 'nanny.forbiddenString')
+        if self._patterns is None:
+            self._patterns = self._read_config('nanny.forbiddenpattern', 'nanny.forbiddenPattern')
+
+        self._compiled_patterns = []
+        for pattern in self._patterns:
+            try:
+                regexp = re.compile(pattern)
+            except re.error, e:
+                raise ConfigError(
+                    'Invalid value for nanny.forbiddenPattern: %r (%s)' % (pattern, e,)
+                    )
+            if regexp.search(''):
+                raise ConfigError(
+                    'Invalid value for nanny.forbiddenPattern: %r (it would match every file)'
+                    % (pattern,)
+                    )
+            self._compiled_patterns.append((pattern, regexp))
+
+        alternatives = []
+        if self._strings:
+            alternatives.append(_literal_alternation(self._strings))
+        self._separate_regexps = []
+        for (pattern, regexp) in self._compiled_patterns:
+            if regexp.flags or regexp.groups:
+                self._separate_regexps.append(regexp)
+            else:
+                alternatives.append('(?:%s)' % (pattern,))
+        self._regexp = re.compile('|'.join(alternatives) or '(?!)')
+
+    def get_fingerprint(self):
+        if self._regexp is None:
+            self._compile()
+        return '%s(strings=%s, patterns=%s)' % (
+            self.__class__.__name__,
+            _fingerprint_value(sorted(self._strings)),
+            _fingerprint_value(self._patterns),
+            )
+
+    def find_forbidden(self, text):
+        """Return a sorted list of the forbidden strings or patterns found in text."""
+
+        if self._regexp is None:
+            self._compile()
+
+        if not (
+                self._regexp.search(text)
+                or any(regexp.search(text) for regexp in self._separate_regexps)
+                ):
+            return []
+
+        found = set(string for string in self._strings if string in text)
+        found.update(
+            pattern
+            for (pattern, regexp) in self._compiled_patterns
+            if regexp.search(text)
+            )
+        return sorted(found)
+
+    def check_text(self, text):
+        return not self.find_forbidden(text)
+
+    def __call__(self, file_change):
+        if file_change.newfile is None:
+            return True
+
+        found = self.find_forbidden(file_change.newfile.contents)
+        if found:
+            metrics.incr('check_failures', labels=(('check', self.__class__.__name__),))
+        for pattern in found:
+            reporter.warning(
+                self.error_fmt % {
+                    'pattern' : pattern,
+                    'filename' : file_change.newfile.filename,
+                    },
+                self.error_summary,
+                )
+
+        return not found
+
+
 class MergeConflictCheck(TextCheck):
     """Don't allow files that appear to have merge conflict markers.
 
@@ -916,6 +2825,7 @@ class MergeConflictCheck(TextCheck):
     merge_marker_re_2 = re.compile(r'^([\<\>\|])\1{6} |^={7}$', re.MULTILINE)
 
     error_fmt = 'Unresolved merge found in %(filename)s'
+    error_summary = 'files with unresolved merges'
 
     def __init__(self, allow_equals=False):
         if allow_equals:
@@ -945,6 +2855,7 @@ class NoExecCheck(FileCheck):
     """Check that the new file is not executable."""
 
     error_fmt = 'File %(filename)s should not be executable'
+    error_summary = 'executable files'
 
     def __call__(self, file_change):
         if file_change.newfile is None:
@@ -952,7 +2863,11 @@ def __call__(self, file_change):
 
         mode = file_change.newfile.mode
         if (mode & 0170000) == 0100000 and (mode & 0111):
-            reporter.warning(self.error_fmt % {'filename' : file_change.newfile.filename})
+            metrics.incr('check_failures', labels=(('check', self.__class__.__name__),))
+            reporter.warning(
+                self.error_fmt % {'filename' : file_change.newfile.filename},
+                self.error_summary,
+                )
             return False
 
         return True
@@ -1016,6 +2931,7 @@ def attribute_then(property, file_check):
 
 ATATAT_CHECK = FileCheckAdapter(
     attribute_then('check-atatat', NewMarkerStringCheck()),
+    pickaxe=MARKER_STRING,
     )
 
 
@@ -1028,16 +2944,28 @@ def attribute_then(property, file_check):
         attribute_then('check-unterminated', UnterminatedLineCheck()),
         attribute_then('check-conflict', MergeConflictCheck()),
         attribute_then('check-conflict-noequals', MergeConflictCheck(allow_equals=True)),
+        attribute_then('check-forbidden', ForbiddenStringCheck()),
         ),
     )
 
 
-PRE_RECEIVE_CHECKS = MultipleCheck(
-    MetadataCheckAdapter(
-        LogMarkerStringCheck(),
-        ),
+LOG_MESSAGE_CHECKS = MetadataCheckAdapter(
+    LogMarkerStringCheck(),
+    )
+
+
+# The checks that don't need to read file contents.  These are cheap
+# enough to be run over all commits before any of the content checks.
+PRE_RECEIVE_CHEAP_CHECKS = MultipleCheck(
+    LOG_MESSAGE_CHECKS,
     FileCheckAdapter(
         attribute_then('check-noexec', NoExecCheck()),
+        ),
+    )
+
+
+PRE_RECEIVE_CONTENT_CHECKS = MultipleCheck(
+    FileCheckAdapter(
         attribute_then('check-trailing-ws', TrailingWhitespaceCheck()),
         attribute_then('check-tab', TabCheck()),
         attribute_then('check-cr', CRCheck()),
@@ -1045,7 +2973,14 @@ def attribute_then(property, file_check):
         attribute_then('check-atatat', MarkerStringCheck()),
         attribute_then('check-conflict', MergeConflictCheck()),
         attribute_then('check-conflict-noequals', MergeConflictCheck(allow_equals=True)),
+        attribute_then('check-forbidden', ForbiddenStringCheck()),
         ),
     )
 
 
+PRE_RECEIVE_CHECKS = MultipleCheck(
+    PRE_RECEIVE_CHEAP_CHECKS,
+    PRE_RECEIVE_CONTENT_CHECKS,
+    )
+
+
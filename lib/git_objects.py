@@ -0,0 +1,503 @@
+"""Read objects directly from a git object database.
+
+This avoids starting a git subprocess (and copying the data through a
+pipe) for every object that is read.  Loose objects and packed objects
+(including delta chains) are supported; pack indexes are mmapped and
+binary-searched.  Anything that this module doesn't understand raises
+ObjectReadError (damaged files can also raise the other exceptions
+listed in READ_ERRORS), in which case the caller should fall back to
+"git cat-file"."""
+
+import os
+import re
+import mmap
+import zlib
+import struct
+import binascii
+import collections
+
+
+OBJ_COMMIT = 1
+OBJ_TREE = 2
+OBJ_BLOB = 3
+OBJ_TAG = 4
+OBJ_OFS_DELTA = 6
+OBJ_REF_DELTA = 7
+
+TYPE_NAMES = {
+    OBJ_COMMIT : 'commit',
+    OBJ_TREE : 'tree',
+    OBJ_BLOB : 'blob',
+    OBJ_TAG : 'tag',
+    }
+
+IDX_V2_MAGIC = '\377tOc'
+
+UINT32 = struct.Struct('>I')
+UINT64 = struct.Struct('>Q')
+
+
+class ObjectReadError(Exception):
+    """An object could not be read by this module."""
+
+    pass
+
+
+class ObjectNotFound(ObjectReadError):
+    pass
+
+
+# The exceptions that reading from a damaged or unexpected object
+# database can raise besides ObjectReadError (e.g., IndexError for a
+# truncated file).  Callers that fall back to "git cat-file" should
+# catch all of them:
+READ_ERRORS = (
+    ObjectReadError, EnvironmentError, IndexError, ValueError, RuntimeError,
+    struct.error, zlib.error,
+    )
+
+
+def _map_file(filename):
+    f = open(filename, 'rb')
+    try:
+        return mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+    finally:
+        f.close()
+
+
+class PackIndex(object):
+    """An mmapped pack index file (version 1 or 2)."""
+
+    def __init__(self, filename):
+        self.map = _map_file(filename)
+        if self.map[:4] == IDX_V2_MAGIC:
+            if UINT32.unpack_from(self.map, 4)[0] != 2:
+                raise ObjectReadError('Unsupported pack index version in %s' % (filename,))
+            self.version = 2
+            fanout = 8
+        else:
+            self.version = 1
+            fanout = 0
+        self.fanout = struct.unpack_from('>256I', self.map, fanout)
+        self.count = self.fanout[255]
+        if self.version == 2:
+            self.names = fanout + 256 * 4
+            self.offsets = self.names + self.count * (20 + 4)
+            self.large_offsets = self.offsets + self.count * 4
+        else:
+            self.entries = fanout + 256 * 4
+
+    def _get_name(self, i):
+        if self.version == 2:
+            start = self.names + i * 20
+        else:
+            start = self.entries + i * 24 + 4
+        return self.map[start:start + 20]
+
+    def _get_offset(self, i):
+        if self.version == 1:
+            return UINT32.unpack_from(self.map, self.entries + i * 24)[0]
+        offset = UINT32.unpack_from(self.map, self.offsets + i * 4)[0]
+        if offset & 0x80000000:
+            offset = UINT64.unpack_from(
+                self.map, self.large_offsets + (offset & 0x7fffffff) * 8,
+                )[0]
+        return offset
+
+    def find(self, binsha):
+        """Return the offset of binsha in the pack, or None if it is not there."""
+
+        first = ord(binsha[0])
+        if first:
+            lo = self.fanout[first - 1]
+        else:
+            lo = 0
+        hi = self.fanout[first]
+        while lo < hi:
+            mid = (lo + hi) // 2
+            name = self._get_name(mid)
+            if name < binsha:
+                lo = mid + 1
+            elif name > binsha:
+                hi = mid
+            else:
+                return self._get_offset(mid)
+        return None
+
+
+class Pack(object):
+    def __init__(self, db, basename):
+        self.db = db
+        self.basename = basename
+        self.index = PackIndex(basename + '.idx')
+        self.map = _map_file(basename + '.pack')
+        if self.map[:4] != 'PACK':
+            raise ObjectReadError('%s.pack is not a pack file' % (basename,))
+
+    def _inflate(self, pos, size):
+        """Decompress the zlib stream at pos, which inflates to size bytes."""
+
+        d = zlib.decompressobj()
+        chunks = []
+        length = 0
+        chunk_size = max(size + 64, 4096)
+        try:
+            while length < size:
+                if pos >= len(self.map):
+                    raise ObjectReadError('Truncated object in %s.pack' % (self.basename,))
+                chunk = d.decompress(self.map[pos:pos + chunk_size])
+                pos += chunk_size
+                chunks.append(chunk)
+                length += len(chunk)
+                if d.unused_data:
+                    break
+        except zlib.error, e:
+            raise ObjectReadError('Corrupt object in %s.pack: %s' % (self.basename, e,))
+        if length != size:
+            raise ObjectReadError('Object has wrong size in %s.pack' % (self.basename,))
+        if len(chunks) == 1:
+            return chunks[0]
+        return ''.join(chunks)
+
+    # A limit on the length of delta chains, to protect against
+    # cycles in corrupt packs (git itself doesn't create chains longer
+    # than 4095):
+    MAX_DELTA_CHAIN = 10000
+
+    def _read_header(self, offset):
+        """Return (type, size, pos) for the object at offset.
+
+        pos is the position just after the object's header."""
+
+        pos = offset
+        c = ord(self.map[pos])
+        pos += 1
+        type = (c >> 4) & 7
+        size = c & 15
+        shift = 4
+        while c & 0x80:
+            c = ord(self.map[pos])
+            pos += 1
+            size |= (c & 0x7f) << shift
+            shift += 7
+        return (type, size, pos)
+
+    def read(self, offset):
+        """Return (type, data) for the object at offset.
+
+        Delta chains are followed iteratively (they can be longer than
+        Python's recursion limit) down to an object that is either not
+        deltified or in the delta base cache; then the deltas are
+        applied in reverse order."""
+
+        # (offset, pos, size) of the deltas to apply, outermost first:
+        deltas = []
+        while True:
+            cached = self.db.delta_base_cache.get((self, offset))
+            if cached is not None:
+                (type, data) = cached
+                break
+
+            if len(deltas) > self.MAX_DELTA_CHAIN:
+                raise ObjectReadError('Delta chain too long in %s.pack' % (self.basename,))
+
+            (type, size, pos) = self._read_header(offset)
+            if type == OBJ_OFS_DELTA:
+                c = ord(self.map[pos])
+                pos += 1
+                base_offset = c & 0x7f
+                while c & 0x80:
+                    c = ord(self.map[pos])
+                    pos += 1
+                    base_offset = ((base_offset + 1) << 7) | (c & 0x7f)
+                deltas.append((offset, pos, size))
+                offset -= base_offset
+            elif type == OBJ_REF_DELTA:
+                base_binsha = self.map[pos:pos + 20]
+                pos += 20
+                deltas.append((offset, pos, size))
+                base_offset = self.index.find(base_binsha)
+                if base_offset is None:
+                    # The base is elsewhere in the database:
+                    (type, data) = self.db.read(binascii.hexlify(base_binsha))
+                    offset = None
+                    break
+                offset = base_offset
+            elif type in TYPE_NAMES:
+                data = self._inflate(pos, size)
+                break
+            else:
+                raise ObjectReadError(
+                    'Unknown object type %d in %s.pack' % (type, self.basename,)
+                    )
+
+        # Now offset is the position of data in this pack (or None):
+        for (delta_offset, pos, size) in reversed(deltas):
+            if offset is not None:
+                self.db.delta_base_cache.put((self, offset), (type, data))
+            data = apply_delta(data, self._inflate(pos, size))
+            offset = delta_offset
+
+        return (type, data)
+
+
+def _read_varint(data, pos):
+    value = shift = 0
+    while True:
+        c = ord(data[pos])
+        pos += 1
+        value |= (c & 0x7f) << shift
+        shift += 7
+        if not c & 0x80:
+            return (value, pos)
+
+
+def apply_delta(base, delta):
+    """Return the result of applying a git delta to base."""
+
+    (base_size, pos) = _read_varint(delta, 0)
+    (result_size, pos) = _read_varint(delta, pos)
+    if base_size != len(base):
+        raise ObjectReadError('Delta base has the wrong size')
+
+    chunks = []
+    end = len(delta)
+    while pos < end:
+        op = ord(delta[pos])
+        pos += 1
+        if op & 0x80:
+            # Copy from base:
+            copy_offset = copy_size = 0
+            for i in range(4):
+                if op & (1 << i):
+                    copy_offset |= ord(delta[pos]) << (8 * i)
+                    pos += 1
+            for i in range(3):
+                if op & (0x10 << i):
+                    copy_size |= ord(delta[pos]) << (8 * i)
+                    pos += 1
+            if copy_size == 0:
+                copy_size = 0x10000
+            chunks.append(base[copy_offset:copy_offset + copy_size])
+        elif op:
+            # Insert literal data:
+            chunks.append(delta[pos:pos + op])
+            pos += op
+        else:
+            raise ObjectReadError('Invalid delta opcode')
+
+    result = ''.join(chunks)
+    if len(result) != result_size:
+        raise ObjectReadError('Delta result has the wrong size')
+    return result
+
+
+class DeltaBaseCache(object):
+    """A small LRU cache of recently-used delta bases, limited by total size."""
+
+    def __init__(self, max_size=16 * 1024 * 1024):
+        self.max_size = max_size
+        self.size = 0
+        self.entries = collections.OrderedDict()
+
+    def get(self, key):
+        value = self.entries.pop(key, None)
+        if value is not None:
+            self.entries[key] = value
+        return value
+
+    def put(self, key, value):
+        if key in self.entries or len(value[1]) > self.max_size:
+            return
+        self.entries[key] = value
+        self.size += len(value[1])
+        while self.size > self.max_size:
+            (old_key, old_value) = self.entries.popitem(last=False)
+            self.size -= len(old_value[1])
+
+
+def _split_alternates(value):
+    """Split a GIT_ALTERNATE_OBJECT_DIRECTORIES-style value into paths.
+
+    Entries are separated by os.pathsep; an entry starting with a
+    double quote is interpreted as a C-style quoted string."""
+
+    paths = []
+    while value:
+        if value.startswith('"'):
+            m = re.match(r'"((?:[^"\\]|\\.)*)"', value)
+            if not m:
+                raise ObjectReadError('Cannot parse alternates %r' % (value,))
+            paths.append(m.group(1).decode('string_escape'))
+            value = value[m.end():]
+            if value.startswith(os.pathsep):
+                value = value[1:]
+        else:
+            (path, sep, value) = value.partition(os.pathsep)
+            if path:
+                paths.append(path)
+    return paths
+
+
+class ObjectDatabase(object):
+    """Objects in an object directory and its alternates.
+
+    If the environment specifies GIT_OBJECT_DIRECTORY and
+    GIT_ALTERNATE_OBJECT_DIRECTORIES (as it does for hooks that run
+    while incoming objects are quarantined), those are honored."""
+
+    MAX_ALTERNATE_DEPTH = 5
+
+    def __init__(self, git_dir, environ=os.environ):
+        objects_dir = environ.get('GIT_OBJECT_DIRECTORY') or os.path.join(git_dir, 'objects')
+        self.object_dirs = []
+        self._add_object_dir(objects_dir, 0)
+        for path in _split_alternates(environ.get('GIT_ALTERNATE_OBJECT_DIRECTORIES', '')):
+            self._add_object_dir(path, 0)
+        self.packs = {}
+        self.delta_base_cache = DeltaBaseCache()
+        self._scan_packs()
+
+    def _add_object_dir(self, path, depth):
+        path = os.path.realpath(path)
+        if path in self.object_dirs or not os.path.isdir(path):
+            return
+        self.object_dirs.append(path)
+        if depth >= self.MAX_ALTERNATE_DEPTH:
+            return
+        try:
+            f = open(os.path.join(path, 'info', 'alternates'))
+        except IOError:
+            return
+        for line in f:
+            line = line.strip()
+            if not line or line.startswith('#'):
+                continue
+            self._add_object_dir(os.path.join(path, line), depth + 1)
+        f.close()
+
+    def _scan_packs(self):
+        """Open any packs that have appeared since the last scan.
+
+        Return True iff new packs were found."""
+
+        found = False
+        for object_dir in self.object_dirs:
+            pack_dir = os.path.join(object_dir, 'pack')
+            try:
+                names = os.listdir(pack_dir)
+            except OSError:
+                continue
+            for name in names:
+                if not name.endswith('.idx'):
+                    continue
+                basename = os.path.join(pack_dir, name[:-4])
+                if basename in self.packs or not os.path.exists(basename + '.pack'):
+                    continue
+                try:
+                    self.packs[basename] = Pack(self, basename)
+                except (EnvironmentError, ValueError, struct.error):
+                    # E.g., the pack is still being written.
+                    continue
+                found = True
+        return found
+
+    def _read_loose(self, sha1):
+        for object_dir in self.object_dirs:
+            try:
+                f = open(os.path.join(object_dir, sha1[:2], sha1[2:]), 'rb')
+            except IOError:
+                continue
+            try:
+                data = zlib.decompress(f.read())
+            except zlib.error, e:
+                raise ObjectReadError('Corrupt loose object %s: %s' % (sha1, e,))
+            finally:
+                f.close()
+
+            (header, data) = data.split('\0', 1)
+            (type_name, size) = header.split(' ')
+            for (type, name) in TYPE_NAMES.iteritems():
+                if name == type_name:
+                    return (type, data)
+            raise ObjectReadError('Unknown object type %r' % (type_name,))
+
+        return None
+
+    def _read_packed(self, binsha):
+        for pack in self.packs.itervalues():
+            offset = pack.index.find(binsha)
+            if offset is not None:
+                return pack.read(offset)
+        return None
+
+    def read(self, sha1):
+        """Return (type, data) for the object with the given hex SHA1.
+
+        Raise ObjectNotFound if the object is not in the database."""
+
+        if len(sha1) != 40:
+            raise ObjectNotFound(sha1)
+        try:
+            binsha = binascii.unhexlify(sha1)
+        except TypeError:
+            raise ObjectNotFound(sha1)
+
+        result = self._read_packed(binsha)
+        if result is None:
+            result = self._read_loose(sha1)
+        if result is None and self._scan_packs():
+            # The object might have been packed in the meantime:
+            result = self._read_packed(binsha)
+        if result is None:
+            raise ObjectNotFound(sha1)
+        return result
+
+    def read_typed(self, sha1, expected_type):
+        (type, data) = self.read(sha1)
+        if type != expected_type:
+            raise ObjectReadError(
+                'Object %s is a %s, not a %s'
+                % (sha1, TYPE_NAMES[type], TYPE_NAMES[expected_type],)
+                )
+        return data
+
+    def read_path(self, commit_sha1, path):
+        """Return the contents of the blob at path in commit commit_sha1.
+
+        Raise ObjectNotFound if there is no blob at that path."""
+
+        commit = self.read_typed(commit_sha1, OBJ_COMMIT)
+        if not commit.startswith('tree '):
+            raise ObjectReadError('Cannot parse commit %s' % (commit_sha1,))
+        sha1 = commit[5:45]
+
+        components = path.split('/')
+        for (i, component) in enumerate(components):
+            tree = self.read_typed(sha1, OBJ_TREE)
+            entry = _find_tree_entry(tree, component)
+            if entry is None:
+                raise ObjectNotFound('%s:%s' % (commit_sha1, path,))
+            (mode, sha1) = entry
+            is_tree = mode.startswith('4')
+            if is_tree != (i < len(components) - 1):
+                raise ObjectNotFound('%s:%s' % (commit_sha1, path,))
+
+        if mode.startswith('16'):
+            # A submodule:
+            raise ObjectNotFound('%s:%s' % (commit_sha1, path,))
+        return self.read_typed(sha1, OBJ_BLOB)
+
+
+def _find_tree_entry(tree, name):
+    """Return (mode, hex SHA1) for name in the tree data, or None."""
+
+    pos = 0
+    end = len(tree)
+    while pos < end:
+        space = tree.index(' ', pos)
+        nul = tree.index('\0', space)
+        if tree[space + 1:nul] == name:
+            return (tree[pos:space], binascii.hexlify(tree[nul + 1:nul + 21]))
+        pos = nul + 21
+    return None
@@ -0,0 +1,210 @@
+"""Watch a directory tree for changes using Linux's inotify."""
+
+import os
+import errno
+import select
+import struct
+import ctypes
+import ctypes.util
+
+
+IN_MODIFY = 0x00000002
+IN_ATTRIB = 0x00000004
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_FROM = 0x00000040
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_DELETE = 0x00000200
+IN_DELETE_SELF = 0x00000400
+IN_Q_OVERFLOW = 0x00004000
+IN_IGNORED = 0x00008000
+IN_ONLYDIR = 0x01000000
+IN_ISDIR = 0x40000000
+
+IN_CLOEXEC = 02000000
+
+WATCH_MASK = (
+    IN_MODIFY | IN_ATTRIB | IN_CLOSE_WRITE
+    | IN_MOVED_FROM | IN_MOVED_TO | IN_CREATE | IN_DELETE | IN_DELETE_SELF
+    | IN_ONLYDIR
+    )
+
+EVENT_HEADER = struct.Struct('iIII')
+
+
+class InotifyError(Exception):
+    pass
+
+
+_libc = None
+
+
+def _get_libc():
+    global _libc
+
+    if _libc is None:
+        libc = ctypes.CDLL(ctypes.util.find_library('c') or 'libc.so.6', use_errno=True)
+        if not hasattr(libc, 'inotify_init1'):
+            raise InotifyError('inotify is not supported on this system')
+        _libc = libc
+    return _libc
+
+
+class InotifyWatcher(object):
+    """Report the paths that change within a directory tree.
+
+    Paths are reported relative to top.  Directories named in exclude
+    (e.g., '.git') are not watched, wherever they appear, but
+    individual directories can be watched via add_dir().
+
+    Nor are the directories in ignored (paths relative to top, e.g.,
+    build outputs) watched.  ignored only applies to the directories
+    that exist when the watcher is created; if is_ignored is set, it
+    is called with the path of each directory that is created later,
+    and should return True if that directory shouldn't be watched."""
+
+    def __init__(self, top, exclude=('.git',), ignored=(), is_ignored=None):
+        self.libc = _get_libc()
+        self.top = top
+        self.exclude = set(exclude)
+        self.is_ignored = is_ignored
+        self.fd = self.libc.inotify_init1(IN_CLOEXEC)
+        if self.fd < 0:
+            raise InotifyError('inotify_init1 failed: %s' % (os.strerror(ctypes.get_errno()),))
+        self.dirs = {}
+        # The watch descriptors of directories whose subdirectories
+        # are not watched:
+        self.shallow = set()
+        self.ignored = set(ignored)
+        self.add_tree('')
+        self.ignored = None
+
+    def close(self):
+        if self.fd is not None:
+            os.close(self.fd)
+            self.fd = None
+
+    def _add_dir(self, path, shallow=False):
+        wd = self.libc.inotify_add_watch(
+            self.fd, os.path.join(self.top, path), WATCH_MASK,
+            )
+        if wd < 0:
+            err = ctypes.get_errno()
+            if err in (errno.ENOENT, errno.ENOTDIR):
+                # The directory disappeared in the meantime:
+                return False
+            msg = 'Cannot watch %r: %s' % (path or self.top, os.strerror(err),)
+            if err == errno.ENOSPC:
+                msg += ' (the limit is set by fs.inotify.max_user_watches)'
+            raise InotifyError(msg)
+        self.dirs[wd] = path
+        if shallow:
+            self.shallow.add(wd)
+        return True
+
+    def _is_ignored(self, path):
+        if self.ignored is not None:
+            # The initial directories are being added:
+            return path in self.ignored
+        return self.is_ignored is not None and self.is_ignored(path)
+
+    def add_dir(self, path):
+        """Watch the directory path, but not its subdirectories.
+
+        path can be outside of top (e.g., the git directory of a linked
+        worktree); if it is absolute, so are the paths reported within
+        it.  Return True iff the directory exists."""
+
+        return self._add_dir(path, shallow=True)
+
+    def add_tree(self, path):
+        """Watch the directory path and all of its subdirectories.
+
+        Return the list of files that were found within them.  Raise
+        InotifyError if a directory cannot be watched (e.g., because
+        the limit on the number of watches has been reached)."""
+
+        files = []
+        if (path and self._is_ignored(path)) or not self._add_dir(path):
+            return files
+        for (dirpath, dirnames, filenames) in os.walk(os.path.join(self.top, path)):
+            rel = os.path.relpath(dirpath, self.top)
+            if rel == '.':
+                rel = ''
+            dirnames[:] = [
+                d
+                for d in dirnames
+                if d not in self.exclude and not self._is_ignored(os.path.join(rel, d))
+                ]
+            for d in dirnames:
+                self._add_dir(os.path.join(rel, d))
+            files.extend(os.path.join(rel, f) for f in filenames)
+        return files
+
+    def read_changes(self, timeout=None):
+        """Wait up to timeout seconds for changes and return the changed paths.
+
+        Return a set of paths, which is empty if the timeout expired,
+        or None if events were lost (in which case everything has to be
+        assumed to have changed).  Raise InotifyError if a new
+        directory cannot be watched."""
+
+        (readable, writable, exceptional) = select.select([self.fd], [], [], timeout)
+        if not readable:
+            return set()
+
+        buf = os.read(self.fd, 65536)
+        changed = set()
+        overflow = False
+        offset = 0
+        while offset < len(buf):
+            (wd, mask, cookie, length) = EVENT_HEADER.unpack_from(buf, offset)
+            offset += EVENT_HEADER.size
+            name = buf[offset:offset + length].rstrip('\0')
+            offset += length
+
+            if mask & IN_Q_OVERFLOW:
+                overflow = True
+                continue
+            elif mask & IN_IGNORED:
+                self.dirs.pop(wd, None)
+                self.shallow.discard(wd)
+                continue
+
+            dirpath = self.dirs.get(wd)
+            if dirpath is None or not name:
+                continue
+            path = os.path.join(dirpath, name)
+
+            if mask & IN_ISDIR:
+                if name in self.exclude or wd in self.shallow:
+                    continue
+                if mask & (IN_CREATE | IN_MOVED_TO):
+                    # Files might have been created before the watch was
+                    # set up:
+                    changed.update(self.add_tree(path))
+            else:
+                changed.add(path)
+
+        if overflow:
+            return None
+        return changed
+
+    def iter_batches(self, debounce):
+        """Iterate over batches of changed paths.
+
+        Wait for changes, then keep collecting them until no more
+        changes have arrived for debounce seconds.  Yield each batch as
+        a set of paths, or None if events were lost."""
+
+        while True:
+            changed = self.read_changes()
+            while True:
+                more = self.read_changes(debounce)
+                if more is None:
+                    changed = None
+                elif not more:
+                    break
+                elif changed is not None:
+                    changed |= more
+            yield changed
@@ -0,0 +1,202 @@
+"""Collect statistics about git-nanny runs and export them.
+
+Statistics are accumulated in memory by the module-level metrics
+object (which is cheap enough to be used on the hot path) and
+exported once at the end of a run, either to a Prometheus
+textfile-collector file or as StatsD datagrams."""
+
+import errno
+import fcntl
+import socket
+import marshal
+
+
+# Upper bounds (in seconds) of the buckets of duration histograms:
+DURATION_BUCKETS = [
+    0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0, 120.0, 300.0,
+    ]
+
+
+class Metrics(object):
+    """Counters and durations, each identified by a name and labels.
+
+    labels is a tuple of (name, value) pairs, like
+    (('subcommand', 'pre-receive'),)."""
+
+    def __init__(self):
+        self.counters = {}
+        self.durations = {}
+        self.recorded = None
+        self.recorded_names = ()
+
+    def incr(self, name, value=1, labels=()):
+        key = (name, labels)
+        self.counters[key] = self.counters.get(key, 0) + value
+        if self.recorded is not None and name in self.recorded_names:
+            self.recorded.append((name, value, labels))
+
+    def start_recording(self, names):
+        """Start remembering the increments of the counters called names.
+
+        This lets cached results be counted as if the work had been
+        done again (see replay())."""
+
+        self.recorded = []
+        self.recorded_names = names
+
+    def stop_recording(self):
+        """Stop remembering increments.
+
+        Return a list of (name, value, labels) for the increments
+        since start_recording()."""
+
+        (increments, self.recorded) = (self.recorded, None)
+        self.recorded_names = ()
+        return increments
+
+    def replay(self, increments):
+        """Repeat increments, as returned by stop_recording()."""
+
+        for (name, value, labels) in increments:
+            self.incr(name, value, labels)
+
+    def observe(self, name, seconds, labels=()):
+        self.durations.setdefault((name, labels), []).append(seconds)
+
+    def _get_histograms(self):
+        """Return {(name, labels) : (bucket_counts, sum, count)} for the durations."""
+
+        histograms = {}
+        for (key, values) in self.durations.iteritems():
+            buckets = [
+                len([v for v in values if v <= bound])
+                for bound in DURATION_BUCKETS
+                ]
+            histograms[key] = (buckets, sum(values), len(values))
+        return histograms
+
+    def write_textfile(self, filename, prefix='git_nanny'):
+        """Add the statistics to those in a Prometheus textfile.
+
+        The accumulated values are kept in filename + '.state', which
+        is locked while it is being updated, so that concurrent runs
+        don't lose each other's statistics.  filename is replaced
+        atomically."""
+
+        from format_checks import write_file_atomically
+
+        lock = open(filename + '.lock', 'a')
+        try:
+            fcntl.flock(lock.fileno(), fcntl.LOCK_EX)
+            try:
+                f = open(filename + '.state', 'rb')
+            except IOError, e:
+                if e.errno != errno.ENOENT:
+                    raise
+                (counters, histograms) = ({}, {})
+            else:
+                try:
+                    (counters, histograms) = marshal.load(f)
+                except (EOFError, ValueError, TypeError):
+                    (counters, histograms) = ({}, {})
+                f.close()
+
+            for (key, value) in self.counters.iteritems():
+                counters[key] = counters.get(key, 0) + value
+            for (key, (buckets, total, count)) in self._get_histograms().iteritems():
+                if key in histograms:
+                    (old_buckets, old_total, old_count) = histograms[key]
+                    buckets = [a + b for (a, b) in zip(old_buckets, buckets)]
+                    total += old_total
+                    count += old_count
+                histograms[key] = (buckets, total, count)
+
+            write_file_atomically(filename + '.state', marshal.dumps((counters, histograms)))
+            write_file_atomically(
+                filename, format_prometheus(counters, histograms, prefix=prefix),
+                mode=0644,
+                )
+        finally:
+            lock.close()
+
+    def send_statsd(self, address, prefix='git_nanny'):
+        """Send the statistics as StatsD datagrams to address, a (host, port) pair.
+
+        Errors are ignored, as befits StatsD."""
+
+        lines = []
+        for ((name, labels), value) in sorted(self.counters.iteritems()):
+            lines.append('%s:%d|c' % (_statsd_name(prefix, name, labels), value))
+        for ((name, labels), values) in sorted(self.durations.iteritems()):
+            for value in values:
+                lines.append(
+                    '%s:%d|ms' % (_statsd_name(prefix, name, labels), int(value * 1000))
+                    )
+
+        s = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        try:
+            # Pack as many lines as fit into each datagram:
+            datagram = ''
+            for line in lines:
+                if datagram and len(datagram) + len(line) >= 1400:
+                    s.sendto(datagram, address)
+                    datagram = ''
+                datagram += (datagram and '\n') + line
+            if datagram:
+                s.sendto(datagram, address)
+        except socket.error:
+            pass
+        finally:
+            s.close()
+
+
+def _format_labels(labels, extra=()):
+    labels = tuple(labels) + tuple(extra)
+    if not labels:
+        return ''
+    return '{%s}' % (
+        ','.join([
+            '%s="%s"' % (name, str(value).replace('\\', '\\\\').replace('"', '\\"'))
+            for (name, value) in labels
+            ]),
+        )
+
+
+def format_prometheus(counters, histograms, prefix='git_nanny'):
+    """Return the Prometheus text exposition of counters and histograms."""
+
+    lines = []
+    for name in sorted(set(name for (name, labels) in counters)):
+        metric = '%s_%s_total' % (prefix, name)
+        lines.append('# TYPE %s counter' % (metric,))
+        for ((n, labels), value) in sorted(counters.iteritems()):
+            if n == name:
+                lines.append('%s%s %d' % (metric, _format_labels(labels), value))
+
+    for name in sorted(set(name for (name, labels) in histograms)):
+        metric = '%s_%s' % (prefix, name)
+        lines.append('# TYPE %s histogram' % (metric,))
+        for ((n, labels), (buckets, total, count)) in sorted(histograms.iteritems()):
+            if n != name:
+                continue
+            for (bound, bucket) in zip(DURATION_BUCKETS, buckets):
+                lines.append('%s_bucket%s %d' % (
+                    metric, _format_labels(labels, [('le', repr(bound))]), bucket,
+                    ))
+            lines.append('%s_bucket%s %d' % (
+                metric, _format_labels(labels, [('le', '+Inf')]), count,
+                ))
+            lines.append('%s_sum%s %r' % (metric, _format_labels(labels), total))
+            lines.append('%s_count%s %d' % (metric, _format_labels(labels), count))
+
+    return ''.join(line + '\n' for line in lines)
+
+
+def _statsd_name(prefix, name, labels):
+    return '.'.join(
+        [prefix, name]
+        + [str(value).replace('.', '_').replace(':', '_') for (label, value) in labels]
+        )
+
+
+metrics = Metrics()